@@ -1,19 +1,215 @@
+import asyncio
+import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy import Engine, event, inspect, make_url, text
+from sqlalchemy.exc import DatabaseError
+from sqlalchemy.pool import QueuePool, SingletonThreadPool, StaticPool
+from sqlmodel import SQLModel, create_engine
 
 # Importing models executes the module. This way, SQLModel knows to create the tables
 # defined in the module in create_all.
 from . import models
+from services.monitoring import metrics
 
 load_dotenv()
 
-connect_args = {"check_same_thread": False}
-engine = create_engine(os.getenv("TEST_DB_CONNECTION_STRING"), pool_size=10)
+logger = logging.getLogger(__name__)
+
+# Sockets don't hold a connection, one is only checked out for each unit of work, so a small pool serves many
+# mostly idle sockets.
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+# Connections opened beyond POOL_SIZE when the pool is exhausted. They are closed when they are returned.
+POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", 0))
+# Test connections with a round trip before using them, to replace the ones the server or network dropped
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Replace connections older than this many seconds when they are checked out. -1 never replaces them.
+POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", 1800))
+# Close the pool's connections after this many seconds without any database work. 0 keeps them open.
+POOL_IDLE_SECONDS = float(os.getenv("DB_POOL_IDLE_SECONDS", 300))
+
+connection_string = os.getenv("TEST_DB_CONNECTION_STRING")
+connect_args = {"check_same_thread": False} if connection_string.startswith("sqlite") else {}
+pool_args = {"pool_pre_ping" : POOL_PRE_PING, "pool_recycle" : POOL_RECYCLE_SECONDS}
+executor_workers = POOL_SIZE + POOL_MAX_OVERFLOW
+connection_url = make_url(connection_string)
+pool_class = connection_url.get_dialect().get_pool_class(connection_url)
+if issubclass(pool_class, QueuePool):
+    pool_args.update(pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW)
+elif issubclass(pool_class, SingletonThreadPool):
+    # An in memory SQLite database lives and dies with its connection. Every thread shares the one connection,
+    # so it is never recycled, and the executor runs one unit of work at a time on it.
+    pool_args.update(poolclass=StaticPool, pool_recycle=-1)
+    executor_workers = 1
+engine = create_engine(connection_string, connect_args=connect_args, **pool_args)
+metrics.instrument_engine(engine)
+
+def pool_connections() -> dict:
+    # Only a QueuePool keeps count of its connections
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {"size" : 0, "checked_out" : 0, "checked_in" : 0, "overflow" : 0}
+    return {"size" : pool.size(), "checked_out" : pool.checkedout(), "checked_in" : pool.checkedin(), "overflow" : pool.overflow()}
+
+# Runs blocking database work on a dedicated thread pool so that a slow query never blocks the event loop.
+# The pool has as many threads as the engine has connections, so work queues here instead of inside the
+# engine's connection pool.
+class DatabaseExecutor:
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        self._lock = threading.Lock()
+
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.peak_queued = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def run(self, fn, *args, **kwargs):
+        submitted_at = time.perf_counter()
+        with self._lock:
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+        
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, submitted_at, fn, args, kwargs)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "max_workers" : self.max_workers,
+                "queued" : self.queued,
+                "running" : self.running,
+                "completed" : self.completed,
+                "peak_queued" : self.peak_queued,
+                "average_wait_seconds" : self.total_wait_seconds / self.completed if self.completed else 0.0,
+                "max_wait_seconds" : self.max_wait_seconds,
+                **{"pool_" + state : value for state, value in pool_connections().items()},
+            }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def _call(self, submitted_at: float, fn, args, kwargs):
+        wait_seconds = time.perf_counter() - submitted_at
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.total_wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+        metrics.db_executor_wait_seconds.observe(wait_seconds)
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+db_executor = DatabaseExecutor(max_workers=executor_workers)
+
+# Closes the pool's connections once the process has gone idle_seconds without checking one out, so a
+# process whose sockets are all idle doesn't keep connections open on the database server. The next unit of
+# work opens them again. Connections checked out while the pool is replaced are closed when they are returned.
+class IdleConnectionReaper:
+    def __init__(self, engine: Engine, idle_seconds: float):
+        self.engine = engine
+        self.idle_seconds = idle_seconds
+        self.reaped = 0
+        self._last_used = time.monotonic()
+        self._task = None
+
+        event.listen(engine, "checkout", self._touch)
+        event.listen(engine, "checkin", self._touch)
+
+    async def start(self) -> None:
+        if self.idle_seconds > 0:
+            self._task = asyncio.create_task(self._reap_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def reap(self) -> bool:
+        # Only the connections of a QueuePool can be closed and opened again without losing anything
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool) or pool.checkedout() or not pool.checkedin() \
+            or time.monotonic() - self._last_used < self.idle_seconds:
+            return False
+
+        self.engine.dispose()
+        self.reaped += 1
+        return True
+
+    async def _reap_loop(self) -> None:
+        while True:
+            await asyncio.sleep(min(self.idle_seconds, 60))
+            try:
+                self.reap()
+            except Exception:
+                logger.exception("Failed to close idle database connections")
+
+    def _touch(self, *args) -> None:
+        self._last_used = time.monotonic()
+
+connection_reaper = IdleConnectionReaper(engine, POOL_IDLE_SECONDS)
+
+# Work waits for a connection in the executor's queue rather than in the pool, so the executor wait histogram
+# above is the pool checkout wait.
+metrics.CallbackMetric("orca_db_executor_tasks", "Database work waiting for or running on the executor.", \
+    lambda: {(state,) : value for state, value in db_executor.metrics().items() if state in ("queued", "running")}, ("state",))
+metrics.CallbackMetric("orca_db_pool_connections", "Connections of the database pool, by state.", \
+    lambda: {(state,) : value for state, value in pool_connections().items()}, ("state",))
+metrics.CallbackMetric("orca_db_pool_reaps_total", "Times the idle database connections were closed.", \
+    lambda: {() : connection_reaper.reaped}, type="counter")
+
+# Columns added to tables that existing databases already have, with the DDL that adds them. create_all only
+# creates missing tables, so these are added by upgrade_db.
+ADDED_COLUMNS = {
+    "schedule" : {"change_seq" : "INTEGER NOT NULL DEFAULT 0"},
+    "activity" : {"change_seq" : "INTEGER NOT NULL DEFAULT 0"},
+}
 
 def create_db():
     SQLModel.metadata.create_all(engine)
+    upgrade_db()
+
+def upgrade_db():
+    # Brings a database created by an earlier version up to date: adds the columns above and every index of
+    # the models that is missing. Running it again changes nothing. Another worker starting at the same time
+    # may add them first, so a failure only counts if the column or index is still missing after it.
+    for table_name, columns in ADDED_COLUMNS.items():
+        for column_name, column_ddl in columns.items():
+            if not _has_column(table_name, column_name):
+                _run_ddl(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_ddl}", lambda: _has_column(table_name, column_name))
+
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            if not _has_index(table.name, index.name):
+                _run_ddl(index.create, lambda: _has_index(table.name, index.name))
+
+def _has_column(table_name: str, column_name: str) -> bool:
+    return column_name in {column["name"] for column in inspect(engine).get_columns(table_name)}
+
+def _has_index(table_name: str, index_name: str) -> bool:
+    return index_name in {index["name"] for index in inspect(engine).get_indexes(table_name)}
 
-def get_session():
-    with Session(engine) as session:
-        yield session
\ No newline at end of file
+def _run_ddl(ddl, applied) -> None:
+    try:
+        with engine.begin() as connection:
+            if isinstance(ddl, str):
+                connection.execute(text(ddl))
+            else:
+                ddl(connection)
+    except DatabaseError:
+        if not applied():
+            raise
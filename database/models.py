@@ -1,6 +1,6 @@
 import uuid as uuid_pkg
 from datetime import datetime
-from sqlmodel import Field, SQLModel
+from sqlmodel import Field, Index, SQLModel
 
 class UserData(SQLModel, table=True):
     id: uuid_pkg.UUID = Field(default_factory=uuid_pkg.uuid4, primary_key=True)
@@ -10,6 +10,7 @@ class Schedule(SQLModel, table=True):
     id: uuid_pkg.UUID = Field(default_factory=uuid_pkg.uuid4, primary_key=True)
     init_week_start : datetime = Field(nullable=False)
     init_timezone_offset: int = Field(default=0, nullable=False)
+    change_seq: int = Field(default=0, nullable=False) # incremented by every change to the schedule's activities
 
 class ScheduleBookmark(SQLModel, table=True):
     user_id: uuid_pkg.UUID = Field(nullable=False, primary_key=True, foreign_key='userdata.id')
@@ -18,6 +19,13 @@ class ScheduleBookmark(SQLModel, table=True):
     week_start_timezone_offset: int = Field(default=0, nullable=False)
 
 class Activity(SQLModel, table=True):
+    # Week range scans and overlap checks filter on the schedule and then on start or end
+    __table_args__ = (
+        Index("ix_activity_schedule_id_start", "schedule_id", "start"),
+        Index("ix_activity_schedule_id_end", "schedule_id", "end"),
+        Index("ix_activity_schedule_id_change_seq", "schedule_id", "change_seq"),
+    )
+
     id: uuid_pkg.UUID = Field(default_factory=uuid_pkg.uuid4, primary_key=True)
     schedule_id: uuid_pkg.UUID = Field(nullable=False, foreign_key='schedule.id')
     title: str = Field(nullable=False)
@@ -29,6 +37,17 @@ class Activity(SQLModel, table=True):
     local_timezone: int = Field(default=0, nullable=False) # timezone +/- hours from UTC
     dest_location : str | None = Field(nullable=True) # only populated if type = transit.
     version : int = Field(nullable=False, default=0)
+    change_seq : int = Field(nullable=False, default=0) # the schedule's change_seq when the activity was last created or updated
+
+# Records deleted activities so that clients catching up on a schedule's changes learn about the deletion.
+class ActivityTombstone(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_activitytombstone_schedule_id_change_seq", "schedule_id", "change_seq"),
+    )
+
+    activity_id: uuid_pkg.UUID = Field(nullable=False, primary_key=True)
+    schedule_id: uuid_pkg.UUID = Field(nullable=False, foreign_key='schedule.id')
+    change_seq: int = Field(nullable=False)
 
 class ActivityDescription(SQLModel, table=True):
     activity_id: uuid_pkg.UUID = Field(nullable=False, primary_key=True, foreign_key='activity.id')
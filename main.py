@@ -2,9 +2,14 @@ import logging;
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
-from database.database import create_db
+from database.database import connection_reaper, create_db, db_executor
+from services.monitoring import metrics
 from services.schedule import router as schedule_router
+from services.schedule.bookmarkStore import bookmark_store
+from services.schedule.intervalIndex import interval_index
+from services.schedule.scheduleCache import description_cache, week_cache
 
 # Reduce logging
 uvicorn_error = logging.getLogger("uvicorn.access")
@@ -28,10 +33,41 @@ app.add_middleware(
 # Include sub-routers
 app.include_router(schedule_router.router)
 
+def cache_metrics(*fields):
+    caches = {"week" : week_cache, "intervals" : interval_index, "descriptions" : description_cache}
+    return {(name, field) : cache.metrics()[field] for name, cache in caches.items() for field in fields}
+
+metrics.CallbackMetric("orca_pending_bookmarks", "Schedule bookmarks waiting to be written.", lambda: {() : bookmark_store.pending()})
+metrics.CallbackMetric("orca_cache_entries", "Entries held by each cache.", lambda: cache_metrics("entries"), ("cache", "field"))
+metrics.CallbackMetric("orca_cache_lookups_total", "Cache lookups and evictions, by cache.", \
+    lambda: cache_metrics("hits", "misses", "evictions"), ("cache", "field"), type="counter")
+
 @app.on_event("startup")
-def on_startup():
+async def on_startup():
     create_db()
+    await schedule_router.broadcast_bus.start()
+    await bookmark_store.start()
+    await connection_reaper.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await schedule_router.broadcast_bus.stop()
+    await bookmark_store.stop()
+    await connection_reaper.stop()
+    db_executor.shutdown()
 
 @app.get("/")
 async def root():
-    return {"Welcome to Orca Service!"}
\ No newline at end of file
+    return {"Welcome to Orca Service!"}
+
+@app.get("/health/db")
+async def db_health():
+    return db_executor.metrics()
+
+@app.get("/health/cache")
+async def cache_health():
+    return {"week" : week_cache.metrics(), "intervals" : interval_index.metrics(), "descriptions" : description_cache.metrics()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable
+
+# Minimal Prometheus style metrics, rendered in the text exposition format by render(). Set METRICS_ENABLED=0 to
+# turn the timers and counters into no-ops.
+enabled = os.getenv("METRICS_ENABLED", "1").lower() not in ("0", "false", "no")
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+def _format_labels(labelnames: tuple, labelvalues: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{str(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timer = _NullTimer()
+
+class _Timer:
+    def __init__(self, histogram: '_HistogramChild'):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+class Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *labelvalues):
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(labelvalues, self._new_child())
+        return child
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for labelvalues, child in list(self._children.items()):
+            lines.extend(child.render(self.name, self.labelnames, labelvalues))
+        return lines
+
+    @abstractmethod
+    def _new_child(self):
+        ...
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        if enabled:
+            with self._lock:
+                self.value += amount
+
+    def render(self, name: str, labelnames: tuple, labelvalues: tuple) -> list[str]:
+        return [f"{name}{_format_labels(labelnames, labelvalues)} {self.value}"]
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+class _HistogramChild:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        if not enabled:
+            return
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def time(self):
+        return _Timer(self) if enabled else _null_timer
+
+    def render(self, name: str, labelnames: tuple, labelvalues: tuple) -> list[str]:
+        with self._lock:
+            counts, total_sum, total_count = list(self.counts), self.sum, self.count
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            le = 'le="%s"' % bound
+            lines.append(f"{name}_bucket{_format_labels(labelnames, labelvalues, le)} {cumulative}")
+        le = 'le="+Inf"'
+        lines.append(f"{name}_bucket{_format_labels(labelnames, labelvalues, le)} {total_count}")
+        lines.append(f"{name}_sum{_format_labels(labelnames, labelvalues)} {total_sum}")
+        lines.append(f"{name}_count{_format_labels(labelnames, labelvalues)} {total_count}")
+        return lines
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time() if enabled else _null_timer
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+# A metric whose samples are read from a callback when the metrics are scraped, for values that are already
+# tracked elsewhere. The callback returns {labelvalues: value}.
+class CallbackMetric(Metric):
+    def __init__(self, name: str, documentation: str, callback: Callable[[], dict], labelnames: tuple = (), type: str = "gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.type = type
+
+    def _new_child(self):
+        # The samples come from the callback, there are no children to update
+        raise TypeError(f"{self.name} is read from its callback")
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for labelvalues, value in self.callback().items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+def instrument_engine(engine) -> None:
+    # Times every statement the engine executes. Nothing is registered when metrics are disabled.
+    if not enabled:
+        return
+
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_started_at = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        db_query_seconds.observe(time.perf_counter() - context._query_started_at)
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+request_parse_seconds = Histogram("orca_request_parse_seconds", "Time spent parsing websocket requests.")
+action_seconds = Histogram("orca_schedule_action_seconds", "Time spent handling a schedule request, by action.", ("action",))
+serialize_seconds = Histogram("orca_response_serialize_seconds", "Time spent serializing responses, by response type.", ("response",))
+fan_out_enqueue_seconds = Histogram("orca_broadcast_fan_out_enqueue_seconds", "Time spent queueing a schedule change for the clients viewing it.")
+fan_out_recipients = Histogram("orca_broadcast_recipients", "Number of clients a schedule change is sent to.", \
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+db_query_seconds = Histogram("orca_db_query_seconds", "Time spent executing database statements.")
+db_executor_wait_seconds = Histogram("orca_db_executor_wait_seconds", "Time database work waits for a free executor thread and connection.")
+outbound_send_seconds = Histogram("orca_outbound_send_seconds", "Time from queueing a frame for a client to the frame being written to its socket.")
+outbound_dropped_frames = Counter("orca_outbound_dropped_frames_total", "Frames dropped because a client's outbound queue was full.")
+outbound_resyncs = Counter("orca_outbound_resyncs_total", "Outbound queues replaced by a snapshot because they were full.")
+outbound_evictions = Counter("orca_outbound_evictions_total", "Clients disconnected for not keeping up, by reason.", ("reason",))
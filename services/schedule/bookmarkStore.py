@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+import uuid as uuid_pkg
+from datetime import datetime, timedelta
+
+from sqlalchemy import tuple_
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlmodel import Session, select
+
+from .scheduleCache import LRUCache
+from database.database import db_executor, engine
+from database.models import Activity, Schedule, ScheduleBookmark
+
+logger = logging.getLogger(__name__)
+
+# Bookmarks written per statement, so the IN list stays within the database's parameter limits
+FLUSH_CHUNK_SIZE = 500
+
+# Buffers the week each client is on and writes the changes to ScheduleBookmark in bulk every flush_interval
+# seconds, instead of running the lookups and a commit for every socket that closes. Only the event loop
+# touches the buffers, the writes run on the database executor.
+class BookmarkStore:
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._pending : dict[tuple[uuid_pkg.UUID, uuid_pkg.UUID], datetime] = {}
+        self._flushing : dict[tuple[uuid_pkg.UUID, uuid_pkg.UUID], datetime] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+        # Schedules' init_timezone_offset, used for new bookmarks in a week without activities
+        self._timezone_offsets = LRUCache(max_entries=int(os.getenv("SCHEDULE_TIMEZONE_CACHE_SIZE", 1024)))
+
+    def get(self, client_id: uuid_pkg.UUID, schedule_id: uuid_pkg.UUID) -> datetime | None:
+        # Bookmarks that haven't been written yet are newer than the database's
+        key = (client_id, schedule_id)
+        week_start = self._pending.get(key)
+        return week_start if week_start is not None else self._flushing.get(key)
+
+    def record(self, client_id: uuid_pkg.UUID, schedule_id: uuid_pkg.UUID, week_start: datetime) -> None:
+        self._pending[(client_id, schedule_id)] = week_start
+
+    def pending(self) -> int:
+        return len(self._pending) + len(self._flushing)
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        # Anything still buffered is written before the process exits
+        await self.flush()
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            self._flushing, self._pending = self._pending, {}
+            try:
+                await db_executor.run(self._write_bookmarks, self._flushing)
+            except Exception:
+                # Retry on the next flush, unless the client has moved to another week since
+                for key, week_start in self._flushing.items():
+                    self._pending.setdefault(key, week_start)
+                raise
+            finally:
+                self._flushing = {}
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write %d schedule bookmarks", len(self._pending))
+
+    def _write_bookmarks(self, bookmarks: dict[tuple[uuid_pkg.UUID, uuid_pkg.UUID], datetime]) -> None:
+        items = list(bookmarks.items())
+        for i in range(0, len(items), FLUSH_CHUNK_SIZE):
+            chunk = dict(items[i:i + FLUSH_CHUNK_SIZE])
+            try:
+                self._write_chunk(chunk)
+            except (DataError, IntegrityError):
+                # One bad bookmark, e.g. of a client that isn't a user, fails its whole chunk. The chunk is written again
+                # one bookmark at a time, and the bookmarks that fail on their own are dropped instead of being retried
+                # forever. Other errors, like a lost connection, are raised so the flush is retried.
+                for key, week_start in chunk.items():
+                    try:
+                        self._write_chunk({key : week_start})
+                    except (DataError, IntegrityError):
+                        logger.warning("Dropped the bookmark of client %s in schedule %s", *key, exc_info=True)
+
+    def _write_chunk(self, chunk: dict[tuple[uuid_pkg.UUID, uuid_pkg.UUID], datetime]) -> None:
+        chunk = dict(chunk)
+        with Session(engine) as db_session:
+            existing_db = db_session.exec(select(ScheduleBookmark).where( \
+                tuple_(ScheduleBookmark.user_id, ScheduleBookmark.schedule_id).in_(list(chunk)))).all()
+
+            for schedule_bookmark_db in existing_db:
+                schedule_bookmark_db.week_start = chunk.pop((schedule_bookmark_db.user_id, schedule_bookmark_db.schedule_id))
+                db_session.add(schedule_bookmark_db)
+
+            # What remains in the chunk are clients' first bookmarks of the schedule
+            time_zone_offsets = {}
+            for (client_id, schedule_id), week_start in chunk.items():
+                if (schedule_id, week_start) not in time_zone_offsets:
+                    time_zone_offsets[(schedule_id, week_start)] = self._get_time_zone_offset(db_session, schedule_id, week_start)
+
+                # The schedule was deleted since the client was on it
+                if time_zone_offsets[(schedule_id, week_start)] is None:
+                    continue
+
+                db_session.add(ScheduleBookmark(user_id=client_id, schedule_id=schedule_id, week_start=week_start, \
+                    week_start_timezone_offset=time_zone_offsets[(schedule_id, week_start)]))
+
+            db_session.commit()
+
+    def _get_time_zone_offset(self, db_session: Session, schedule_id: uuid_pkg.UUID, week_start: datetime) -> int | None:
+        # Use the timezone of the week's first activity, or the schedule's when the week is empty. None if the
+        # schedule doesn't exist.
+        week_end = week_start + timedelta(weeks=1)
+        time_zone_offset_db = db_session.exec(select(Activity.local_timezone).where(Activity.schedule_id == schedule_id, \
+            Activity.start > week_start, Activity.end < week_end).order_by(Activity.start).limit(1)).one_or_none()
+        if time_zone_offset_db is not None:
+            return time_zone_offset_db
+
+        time_zone_offset = self._timezone_offsets.get(schedule_id)
+        if time_zone_offset is None:
+            time_zone_offset = db_session.exec(select(Schedule.init_timezone_offset).where(Schedule.id == schedule_id)).one_or_none()
+            if time_zone_offset is not None:
+                self._timezone_offsets.put(schedule_id, time_zone_offset)
+        return time_zone_offset
+
+bookmark_store = BookmarkStore(flush_interval=float(os.getenv("BOOKMARK_FLUSH_SECONDS", 5)))
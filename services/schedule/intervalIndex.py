@@ -0,0 +1,120 @@
+import os
+import threading
+from bisect import bisect_left, insort
+from datetime import datetime
+
+from .scheduleCache import LRUCache
+
+# The time ranges of a schedule's activities sorted by (start, end). Activities in a schedule never overlap, so the
+# ends are sorted as well and an overlap check only has to look at the neighbours of where the new range would go.
+class ScheduleIntervals:
+    def __init__(self, intervals: list[tuple[datetime, datetime, str]], change_seq: int | None = None):
+        self._intervals = sorted((start, end, str(activity_id)) for start, end, activity_id in intervals)
+        self._ranges = {activity_id : (start, end) for start, end, activity_id in self._intervals}
+        self._lock = threading.Lock()
+
+        # The schedule's change_seq that the intervals are up to date with, None once they missed a change
+        self.change_seq = change_seq
+
+    def __len__(self) -> int:
+        return len(self._intervals)
+
+    def copy(self) -> 'ScheduleIntervals':
+        with self._lock:
+            return ScheduleIntervals(self._intervals, self.change_seq)
+
+    def overlaps(self, start: datetime, end: datetime, activity_id = None) -> bool:
+        activity_id = str(activity_id)
+        with self._lock:
+            index = bisect_left(self._intervals, (start,))
+
+            # Earlier activities overlap if they end after the start. Their ends only decrease going left.
+            i = index - 1
+            while i >= 0 and self._intervals[i][1] > start:
+                if self._intervals[i][2] != activity_id:
+                    return True
+                i -= 1
+
+            # Later activities overlap if they begin before the end.
+            i = index
+            while i < len(self._intervals) and self._intervals[i][0] < end:
+                if self._intervals[i][1] > start and self._intervals[i][2] != activity_id:
+                    return True
+                i += 1
+
+            return False
+
+    def add(self, activity_id, start: datetime, end: datetime) -> None:
+        with self._lock:
+            self._remove(str(activity_id))
+            insort(self._intervals, (start, end, str(activity_id)))
+            self._ranges[str(activity_id)] = (start, end)
+
+    def remove(self, activity_id) -> None:
+        with self._lock:
+            self._remove(str(activity_id))
+
+    def apply(self, change_seq: int, changes: list[tuple]) -> None:
+        # Applies the committed change with the given change_seq. Changes are committed in change_seq order but
+        # can be applied out of order, so the intervals only stay current if this is the change after theirs.
+        with self._lock:
+            if self.change_seq is None or change_seq <= self.change_seq:
+                # Either a change was missed, or the intervals were loaded after this one
+                return
+
+            for activity_id, time_range in changes:
+                self._remove(str(activity_id))
+                if time_range:
+                    insort(self._intervals, (*time_range, str(activity_id)))
+                    self._ranges[str(activity_id)] = time_range
+            self.change_seq = change_seq if change_seq == self.change_seq + 1 else None
+
+    def _remove(self, activity_id: str) -> None:
+        if activity_id not in self._ranges:
+            return
+
+        start, end = self._ranges.pop(activity_id)
+        index = bisect_left(self._intervals, (start, end, activity_id))
+        del self._intervals[index]
+
+# The loaded ScheduleIntervals of the most recently used schedules.
+class IntervalIndex(LRUCache):
+    def __init__(self, max_entries: int):
+        super().__init__(max_entries)
+        # Bumped on every change to a schedule, so that a load that raced with a change isn't kept.
+        self._generations : dict[str, int] = {}
+
+    def get_intervals(self, schedule_id: str, change_seq: int) -> ScheduleIntervals | None:
+        # The schedule's intervals, if they are up to date with the schedule at change_seq
+        intervals = self.get(str(schedule_id))
+        if intervals is None or intervals.change_seq != change_seq:
+            return None
+        return intervals
+
+    def generation(self, schedule_id: str) -> int:
+        with self._lock:
+            return self._generations.get(str(schedule_id), 0)
+
+    def put_intervals(self, schedule_id: str, intervals: ScheduleIntervals, generation: int) -> None:
+        with self._lock:
+            if self._generations.get(str(schedule_id), 0) == generation:
+                self._put(str(schedule_id), intervals)
+
+    def apply(self, schedule_id: str, change_seq: int, changes: list[tuple]) -> None:
+        # Records a committed change to the schedule, as the (activity_id, (start, end)) of each activity it added or
+        # moved and (activity_id, None) for each it removed, in the order they were made.
+        intervals = self._changed(schedule_id)
+        if intervals is not None:
+            intervals.apply(change_seq, changes)
+
+    def invalidate(self, schedule_id: str) -> None:
+        with self._lock:
+            self._generations[str(schedule_id)] = self._generations.get(str(schedule_id), 0) + 1
+            self._entries.pop(str(schedule_id), None)
+
+    def _changed(self, schedule_id: str) -> ScheduleIntervals | None:
+        with self._lock:
+            self._generations[str(schedule_id)] = self._generations.get(str(schedule_id), 0) + 1
+            return self._entries.get(str(schedule_id))
+
+interval_index = IntervalIndex(max_entries=int(os.getenv("INTERVAL_INDEX_SIZE", 256)))
@@ -5,4 +5,10 @@ class RequestActions(str, Enum):
     CreateActivity = "POST"
     UpdateActivity = "PATCH"
     DeleteActivity = "DELETE"
-    GetWeekOfActivities = "FULLWEEK"
\ No newline at end of file
+    GetWeekOfActivities = "FULLWEEK"
+    BatchActivities = "BATCH"
+    SyncActivities = "SYNC"
+
+# Actions that change the schedule. Their responses are broadcast and they are run one at a time per schedule.
+WRITE_ACTIONS = frozenset((RequestActions.CreateActivity, RequestActions.UpdateActivity, RequestActions.DeleteActivity, \
+    RequestActions.BatchActivities))
@@ -1,45 +1,174 @@
-import json
-from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect
-from sqlmodel import Session
+import asyncio
+import csv
+import logging
+import os
+import uuid as uuid_pkg
+from collections import defaultdict
+from datetime import datetime
+from fastapi import APIRouter, HTTPException, Request as HTTPRequest, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 
 from ..websocket.responseStatus import ResponseStatus
-from .requestActions import RequestActions
-from ..websocket.protocols import Request
-from database.database import get_session
+from .requestActions import RequestActions, WRITE_ACTIONS
+from ..websocket.broadcastBus import create_broadcast_bus
+from ..websocket.encoding import decode_frame, negotiate_encoding, to_naive_utc
+from ..websocket.protocols import ActivityResponse, Request, ResponseBase
+from ..monitoring import metrics
+from database.database import db_executor
 from .scheduleService import ScheduleService
 from .scheduleConnManager import ScheduleConnectionManager
+from .scheduleExport import EXPORT_MEDIA_TYPES, ExportFormat, schedule_exists, stream_activities
+from .scheduleImport import ImportFormat, ImportTooLarge, create_spool, import_activities
+from .utilities import get_start_date_of_week
+from .writeSerializer import schedule_writes
+
+logger = logging.getLogger(__name__)
+
+# Requests a connection can have in flight before its socket stops being read
+MAX_PIPELINED_REQUESTS = int(os.getenv("MAX_PIPELINED_REQUESTS", 16))
 
 router = APIRouter(prefix="/v1/schedule")
 
+# Shared by every socket in the process so that broadcasts reach all the clients of a schedule.
+broadcast_bus = create_broadcast_bus()
+websocket_manager = ScheduleConnectionManager(broadcast_bus)
+metrics.CallbackMetric("orca_schedule_open_sockets", "Open websockets, by schedule.", websocket_manager.open_sockets, ("schedule_id",))
+metrics.CallbackMetric("orca_outbound_queued_frames", "Frames waiting in the outbound queues.", lambda: {() : websocket_manager.queued_frames()})
+metrics.CallbackMetric("orca_schedule_writes_waiting", "Writes waiting for an earlier write of the same schedule.", lambda: {() : schedule_writes.waiting()})
+
+@router.get("/{schedule_id}/export")
+async def export_schedule(schedule_id: uuid_pkg.UUID, start: datetime | None = None, end: datetime | None = None, \
+    format: ExportFormat = ExportFormat.NDJSON, descriptions: bool = False):
+    if not await db_executor.run(schedule_exists, schedule_id):
+        raise HTTPException(status_code=404, detail="Schedule not found")
+
+    # Bounds with an offset are compared in UTC, like the stored timestamps
+    start = to_naive_utc(start) if start else None
+    end = to_naive_utc(end) if end else None
+
+    # The activities are written out page by page as they are read
+    return StreamingResponse(stream_activities(schedule_id, start, end, format, descriptions), media_type=EXPORT_MEDIA_TYPES[format])
+
+@router.post("/{schedule_id}/import")
+async def import_schedule(schedule_id: uuid_pkg.UUID, request: HTTPRequest, format: ImportFormat = ImportFormat.CSV):
+    # The body is spooled as it arrives, and parsed row by row from the spool
+    with create_spool() as upload:
+        async for chunk in request.stream():
+            upload.write(chunk)
+        upload.seek(0)
+
+        # An import is a write like any other, so it runs and is broadcast in turn with the schedule's other writes
+        async with schedule_writes.serialize(schedule_id):
+            try:
+                result = await db_executor.run(import_activities, schedule_id, upload, format)
+            except ImportTooLarge as e:
+                raise HTTPException(status_code=413, detail=str(e))
+            except (csv.Error, ValueError) as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+            if result is None:
+                raise HTTPException(status_code=404, detail="Schedule not found")
+
+            report, activities = result
+            await _broadcast_import(schedule_id, report["change_seq"], activities)
+
+    return report
+
+async def _broadcast_import(schedule_id: uuid_pkg.UUID, change_seq: int | None, activities: list[dict]) -> None:
+    # Notify the clients viewing the weeks that were imported into, one week of activities at a time
+    weeks = defaultdict(list)
+    for activity in activities:
+        weeks[get_start_date_of_week(datetime.fromisoformat(activity["start"]), activity["local_timezone"])].append(activity)
+    for week, week_activities in weeks.items():
+        changed_ranges = [(datetime.fromisoformat(activity["start"]), datetime.fromisoformat(activity["end"])) for activity in week_activities]
+        await websocket_manager.send_response_to_pool(schedule_id, ActivityResponse(status=ResponseStatus.SUCCESS, \
+            action=RequestActions.CreateActivity, target_week=week, activities=week_activities, change_seq=change_seq, \
+            changed_ranges=changed_ranges))
+
 @router.websocket("/{schedule_id}/{client_id}")
-async def schedule_websocket(websocket: WebSocket, schedule_id: str, client_id: str, db_session: Session = Depends(get_session)):
-    websocket_manager = ScheduleConnectionManager(db_session)
-    schedule_service = ScheduleService(db_session)
-    
-    await websocket_manager.connect(websocket, client_id, schedule_id)
-    
-    # Send the client the initial list of activities
-    initial_activities = schedule_service.get_activities(schedule_id, websocket_manager.target_week[client_id])
-    await websocket_manager.send_response([client_id], initial_activities)
+async def schedule_websocket(websocket: WebSocket, schedule_id: uuid_pkg.UUID, client_id: uuid_pkg.UUID, encoding: str | None = None, \
+    since_seq: int | None = None):
+    # Resolve the week the client starts on and load its activities in one go. The schedule's changes are
+    # followed from before the read.
+    async with websocket_manager.opening(schedule_id):
+        initial_activities = await ScheduleService.bootstrap(client_id, schedule_id)
+        if not initial_activities:
+            await websocket.close()
+            return
+
+        # Clients can ask for binary MessagePack frames with ?encoding=msgpack, otherwise frames are JSON text.
+        # The socket gets an id of its own, since the same client can have several sockets open.
+        connection_id = uuid_pkg.uuid4()
+        await websocket_manager.connect(websocket, connection_id, client_id, schedule_id, initial_activities.target_week, negotiate_encoding(encoding))
 
+    # Send the client the initial list of activities. Clients that reconnect with the change_seq they last saw
+    # only get what changed since.
+    if since_seq is not None:
+        sync_response = await ScheduleService.sync_activities(schedule_id, since_seq)
+        if sync_response.status == ResponseStatus.SUCCESS:
+            initial_activities = sync_response
+    await websocket_manager.send_response([connection_id], initial_activities)
+
+    # Requests are pipelined: each runs in its own task and clients match responses to requests by their id.
+    # Reads run concurrently, but wait for the connection's earlier writes so a client always reads its own
+    # writes. At most MAX_PIPELINED_REQUESTS are in flight, after that the socket isn't read until one finishes.
+    in_flight = asyncio.Semaphore(MAX_PIPELINED_REQUESTS)
+    request_tasks = set()
+    last_write = None
     try:
         while True:
-            client_data = await websocket.receive_text()      
-            client_json = json.loads(client_data)
-            response = None
-            
-            client_request = Request(client_json)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            client_json = None
+
+            try:
+                with metrics.request_parse_seconds.time():
+                    # Frames that aren't valid JSON or MessagePack raise a ValueError
+                    client_json = decode_frame(message)
+                    client_request = Request(client_json)
+            except (KeyError, TypeError, ValueError):
+                request_id = client_json.get('id') if isinstance(client_json, dict) else None
+                await websocket_manager.send_response([connection_id], ResponseBase(status=ResponseStatus.INVALID, action=None, request_id=request_id))
+                continue
+
             if client_request.action == RequestActions.GetWeekOfActivities:
-                websocket_manager.update_client_target_week(client_request.client_id, client_request.target_week)
-
-            response = schedule_service.get_response(schedule_id, client_request)
-            if not response or response.status != ResponseStatus.SUCCESS:
-                await websocket_manager.send_response([client_id], response)
-            elif response.action == RequestActions.GetWeekOfActivities or response.action == RequestActions.GetActivity:
-                await websocket_manager.send_response([client_id], response)
-            else:
-                await websocket_manager.send_response_to_pool(schedule_id, response)
+                websocket_manager.update_client_target_week(connection_id, client_request.target_week)
+
+            await in_flight.acquire()
+            request_task = asyncio.create_task(_process_request(schedule_id, connection_id, client_request, last_write))
+            request_tasks.add(request_task)
+            request_task.add_done_callback(lambda task: (request_tasks.discard(task), in_flight.release()))
+            if client_request.action in WRITE_ACTIONS:
+                last_write = request_task
     except WebSocketDisconnect:
-        websocket_manager.disconnect(client_id)
+        pass
+    finally:
+        # Let the requests already received finish, so their writes are still broadcast to the other clients
+        if request_tasks:
+            await asyncio.wait(request_tasks)
+        await websocket_manager.disconnect(connection_id)
+
+async def _process_request(schedule_id: uuid_pkg.UUID, connection_id: uuid_pkg.UUID, request: Request, last_write: asyncio.Task | None) -> None:
+    try:
+        if request.action in WRITE_ACTIONS:
+            # The broadcast is sent before the next write of the schedule runs
+            async with schedule_writes.serialize(schedule_id):
+                response = await ScheduleService.get_response(schedule_id, request)
+                await _send_response(schedule_id, connection_id, response)
+        else:
+            if last_write is not None:
+                await asyncio.wait((last_write,))
+            response = await ScheduleService.get_response(schedule_id, request)
+            await _send_response(schedule_id, connection_id, response)
+    except Exception:
+        logger.exception("Failed to handle %s request %s of schedule %s", request.action, request.id, schedule_id)
+        await websocket_manager.send_response([connection_id], ResponseBase(status=ResponseStatus.SERVER_ERROR, action=request.action, \
+            request_id=request.id))
 
-    
\ No newline at end of file
+async def _send_response(schedule_id: uuid_pkg.UUID, connection_id: uuid_pkg.UUID, response: ResponseBase) -> None:
+    # Successful writes go to every client of the schedule, everything else only to the socket that asked
+    if response.status == ResponseStatus.SUCCESS and response.action in WRITE_ACTIONS:
+        await websocket_manager.send_response_to_pool(schedule_id, response, reply_to=connection_id)
+    else:
+        await websocket_manager.send_response([connection_id], response)
@@ -0,0 +1,180 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from .utilities import week_key, week_overlaps_span, week_span
+
+# A thread safe LRU cache. The cache is shared by the event loop and the database executor threads.
+class LRUCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._put(key, value)
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "entries" : len(self._entries),
+                "max_entries" : self.max_entries,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+            }
+
+    def _put(self, key, value) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            evicted_key, _ = self._entries.popitem(last=False)
+            self.evictions += 1
+            self._on_evict(evicted_key)
+
+    def _on_evict(self, key) -> None:
+        pass
+
+# Serialized FULLWEEK payloads keyed by (schedule_id, week key). The activities are stored in their JSON form
+# so that a cached week can be sent without touching the database session that loaded it, along with the
+# schedule's change_seq at the time they were loaded.
+class WeekCache(LRUCache):
+    def __init__(self, max_entries: int):
+        super().__init__(max_entries)
+        # The keys of the weeks that are cached for each schedule, used to find the entries a change affects.
+        self._schedule_weeks : dict[str, set[int]] = {}
+
+        # Bumped on every invalidation of the schedule. A read that started before a change must not cache
+        # what it loaded, since it may not include the change.
+        self._generations : dict[str, int] = {}
+
+    def get_week(self, schedule_id: str, week_start: datetime) -> tuple[int, tuple[dict]] | None:
+        return self.get((str(schedule_id), week_key(week_start)))
+
+    def generation(self, schedule_id: str) -> int:
+        with self._lock:
+            return self._generations.get(str(schedule_id), 0)
+
+    def put_week(self, schedule_id: str, week_start: datetime, change_seq: int, activities: list[dict], generation: int) -> None:
+        with self._lock:
+            if self._generations.get(str(schedule_id), 0) != generation:
+                return
+            self._schedule_weeks.setdefault(str(schedule_id), set()).add(week_key(week_start))
+            self._put((str(schedule_id), week_key(week_start)), (change_seq, tuple(activities)))
+
+    def invalidate_activity(self, schedule_id: str, start: datetime, end: datetime) -> None:
+        # Drop every cached week that the activity's time range could have appeared in
+        span = week_span(start, end)
+        with self._lock:
+            self._bump_generation(str(schedule_id))
+            weeks = self._schedule_weeks.get(str(schedule_id))
+            if not weeks:
+                return
+
+            for key in [key for key in weeks if week_overlaps_span(key, span)]:
+                self._entries.pop((str(schedule_id), key), None)
+                self._forget_week(str(schedule_id), key)
+
+    def invalidate_schedule(self, schedule_id: str) -> None:
+        with self._lock:
+            self._bump_generation(str(schedule_id))
+            for key in self._schedule_weeks.pop(str(schedule_id), ()):
+                self._entries.pop((str(schedule_id), key), None)
+
+    def _on_evict(self, key) -> None:
+        self._forget_week(*key)
+
+    def _bump_generation(self, schedule_id: str) -> None:
+        self._generations[schedule_id] = self._generations.get(schedule_id, 0) + 1
+
+    def _forget_week(self, schedule_id: str, key: int) -> None:
+        weeks = self._schedule_weeks.get(schedule_id)
+        if weeks is not None:
+            weeks.discard(key)
+            if not weeks:
+                del self._schedule_weeks[schedule_id]
+
+week_cache = WeekCache(max_entries=int(os.getenv("WEEK_CACHE_SIZE", 1024)))
+
+# Stands for an activity that has no description, so that detail views of those don't go to the database either
+NO_DESCRIPTION = ""
+
+# Activity descriptions keyed by activity id, for the activity detail view (GET).
+class DescriptionCache(LRUCache):
+    def __init__(self, max_entries: int):
+        super().__init__(max_entries)
+        # The schedule of each cached description and the cached descriptions of each schedule, used to drop
+        # a schedule's descriptions when its changes can no longer be followed.
+        self._activity_schedules : dict[str, str] = {}
+        self._schedule_activities : dict[str, set[str]] = {}
+
+        # Bumped by every change to a description. A read that started before a change must not cache what it loaded.
+        self._generation = 0
+
+    def get_description(self, activity_id) -> str | None:
+        return self.get(str(activity_id))
+
+    def generation(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def put_descriptions(self, descriptions: dict[str, tuple[str, str]], generation: int) -> None:
+        # The descriptions are keyed by activity id, along with the id of the activity's schedule
+        with self._lock:
+            if self._generation != generation:
+                return
+            for activity_id, (schedule_id, description) in descriptions.items():
+                self._forget_activity(str(activity_id))
+                self._activity_schedules[str(activity_id)] = str(schedule_id)
+                self._schedule_activities.setdefault(str(schedule_id), set()).add(str(activity_id))
+                self._put(str(activity_id), description)
+
+    def invalidate_activities(self, activity_ids) -> None:
+        with self._lock:
+            self._generation += 1
+            for activity_id in activity_ids:
+                self._entries.pop(str(activity_id), None)
+                self._forget_activity(str(activity_id))
+
+    def invalidate_schedule(self, schedule_id: str) -> None:
+        with self._lock:
+            self._generation += 1
+            for activity_id in self._schedule_activities.pop(str(schedule_id), ()):
+                self._entries.pop(activity_id, None)
+                del self._activity_schedules[activity_id]
+
+    def _on_evict(self, key) -> None:
+        self._forget_activity(key)
+
+    def _forget_activity(self, activity_id: str) -> None:
+        schedule_id = self._activity_schedules.pop(activity_id, None)
+        if schedule_id is None:
+            return
+
+        activities = self._schedule_activities[schedule_id]
+        activities.discard(activity_id)
+        if not activities:
+            del self._schedule_activities[schedule_id]
+
+description_cache = DescriptionCache(max_entries=int(os.getenv("DESCRIPTION_CACHE_SIZE", 4096)))
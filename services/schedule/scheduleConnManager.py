@@ -1,86 +1,200 @@
-from datetime import datetime, timedelta
+import uuid as uuid_pkg
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator
 
 from fastapi import WebSocket
-from sqlmodel import Session, select
-from .utilities import are_dates_in_same_week, get_start_date_of_week
+from sqlmodel import Session
+from .bookmarkStore import bookmark_store
+from .intervalIndex import interval_index
+from .requestActions import RequestActions
+from .scheduleCache import description_cache, week_cache
+from .scheduleService import ScheduleService
+from .utilities import week_key, week_overlaps_span, week_span
+from ..websocket.broadcastBus import BroadcastBus, ScheduleEvent
 from ..websocket.connectionManager import ConnectionManager
-from ..websocket.protocols import ResponseBase
-from database.models import Schedule, ScheduleBookmark, Activity
+from ..websocket.encoding import FrameEncoding, Payload
+from ..websocket.protocols import ActivityResponse, ResponseBase
+from ..websocket.responseStatus import ResponseStatus
+from database.database import db_executor, engine
+from ..monitoring import metrics
 
 class ScheduleConnectionManager(ConnectionManager):
-    def __init__(self, db_session: Session):
+    def __init__(self, bus: BroadcastBus):
         super().__init__()
-        self.db_session = db_session
-        self.client_schedule_connection = {}
-        
-        # The start of the week the user is on.
-        self.target_week = {}
-
-    async def connect(self, websocket: WebSocket, client_id: str, schedule_id: str) -> bool:
-        await super().connect(websocket, client_id)
-
-        # Connect the client to the schedule in order to get notifications
-        self.client_schedule_connection[client_id] = schedule_id
-  
-        # Determine which week of the schedule the client was last on.
-        week_start_db = self.db_session.exec(select(ScheduleBookmark.week_start).where(ScheduleBookmark.user_id == client_id, \
-            ScheduleBookmark.schedule_id == schedule_id).limit(1)).one_or_none()
-        
-        if not week_start_db:
-            # Determine the target_week from the earliest activity in the schedule
-            earliest_start_db = self.db_session.exec(select(Activity.start).where(Activity.schedule_id == schedule_id) \
-                .order_by(Activity.start).limit(1)).one_or_none()
-
-            if not earliest_start_db:
-                schedule_start_db = self.db_session.exec(select(Schedule.init_week_start).where(Schedule.id == schedule_id)).one_or_none()
-                if not schedule_start_db:
-                    return False
-                else:
-                    self.target_week[client_id] = get_start_date_of_week(schedule_start_db)
-            else:
-                self.target_week[client_id] = get_start_date_of_week(earliest_start_db)
-        else:
-            self.target_week[client_id] = week_start_db
-        
-        return True
+        self.bus = bus
+
+        # The schedule, client and week of each socket, by connection id
+        self.client_schedule_connection : dict[uuid_pkg.UUID, uuid_pkg.UUID] = {}
+        self.connection_client : dict[uuid_pkg.UUID, uuid_pkg.UUID] = {}
+        # The start of the week the socket is on, and the key of the room it is in for that week
+        self.target_week : dict[uuid_pkg.UUID, datetime] = {}
+        self.connection_room : dict[uuid_pkg.UUID, int] = {}
+
+        # Sockets grouped by the schedule and then the week they are viewing, so that a broadcast
+        # only visits the sockets that need the update.
+        # Weeks are identified by their utilities.week_key.
+        self.rooms : dict[uuid_pkg.UUID, dict[int, set[uuid_pkg.UUID]]] = {}
+
+        # Sockets that are being opened and haven't joined a room yet, by schedule
+        self.opening_connections : dict[uuid_pkg.UUID, int] = {}
+
+        # Events that the bus missed while it was disconnected could have changed any of the subscribed schedules
+        self.bus.reconnect_handler = self._invalidate_schedule_caches
+
+    @asynccontextmanager
+    async def opening(self, schedule_id: uuid_pkg.UUID) -> AsyncIterator[None]:
+        # The schedule is subscribed to before a new socket's first read, so a change made by another process
+        # during the read still invalidates what the read caches. The socket connects inside the block.
+        self._follow(schedule_id)
+        self.opening_connections[schedule_id] = self.opening_connections.get(schedule_id, 0) + 1
+        try:
+            yield
+        finally:
+            self.opening_connections[schedule_id] -= 1
+            if not self.opening_connections[schedule_id]:
+                del self.opening_connections[schedule_id]
+            self._unfollow(schedule_id)
+
+    async def connect(self, websocket: WebSocket, connection_id: uuid_pkg.UUID, client_id: uuid_pkg.UUID, schedule_id: uuid_pkg.UUID, \
+        target_week: datetime, encoding: FrameEncoding = FrameEncoding.JSON) -> None:
+        await super().connect(websocket, connection_id, encoding)
+
+        # Connect the socket to the schedule in order to get notifications
+        self.client_schedule_connection[connection_id] = schedule_id
+        self.connection_client[connection_id] = client_id
+        self.target_week[connection_id] = target_week
+        self._join_room(connection_id, schedule_id, target_week)
     
-    def disconnect(self, client_id: str) -> None:
-        super().disconnect(client_id)
-   
-        # Save the week that the user was on before disconnecting
-        schedule_id = self.client_schedule_connection[client_id]
-        if schedule_id:
-            schedule_bookmark_db = self.db_session.exec(select(ScheduleBookmark).where(ScheduleBookmark.user_id == client_id, \
-                ScheduleBookmark.schedule_id == schedule_id)).one_or_none()
-            
-            if not schedule_bookmark_db:
-                # Use the client's last known target_week's activities to determine timezone
-                target_week = self.target_week[client_id]
-                target_week_end = target_week + timedelta(weeks=1)
-                time_zone_offset_db = self.db_session.exec(select(Activity.local_timezone).where(Activity.schedule_id == schedule_id, \
-                    Activity.start > target_week, Activity.end < target_week_end).order_by(Activity.start).limit(1)).one_or_none()
-
-                if not time_zone_offset_db:
-                    time_zone_offset_db = self.db_session.exec(select(Schedule.init_timezone_offset).where(Schedule.id == schedule_id)).one()
-
-                new_last_visited = ScheduleBookmark(user_id=client_id, schedule_id=schedule_id, week_start=target_week, week_start_timezone_offset=time_zone_offset_db)
-                self.db_session.add(new_last_visited)
-                self.db_session.commit()
-            else:
-                schedule_bookmark_db.week_start = self.target_week[client_id]
-                self.db_session.add(schedule_bookmark_db)
-                self.db_session.commit() 
-
-        # Disconnect the client from the schedule
-        del self.client_schedule_connection[client_id]
-        del self.target_week[client_id]
+    async def disconnect(self, connection_id: uuid_pkg.UUID) -> None:
+        if connection_id not in self.client_schedule_connection:
+            return
+
+        super().disconnect(connection_id)
+        schedule_id = self.client_schedule_connection[connection_id]
+        client_id = self.connection_client[connection_id]
+        target_week = self.target_week[connection_id]
+
+        # Disconnect the socket from the schedule. The rest of the socket's state is removed and its bookmark
+        # saved even if leaving the room fails.
+        try:
+            self._leave_room(connection_id)
+        finally:
+            del self.client_schedule_connection[connection_id]
+            del self.connection_client[connection_id]
+            del self.target_week[connection_id]
+
+            # Save the week that the user was on before disconnecting. The store writes it in the next flush.
+            bookmark_store.record(client_id, schedule_id, target_week)
     
-    async def send_response_to_pool(self, schedule_id: str, response: ResponseBase):
-        # Notify all clients that are connected to the schedule and are currently viewing the week
-        # that's being updated
-        for client_id, conn_schedule_id in self.client_schedule_connection.items():
-            if conn_schedule_id == schedule_id and are_dates_in_same_week(response.target_week, self.target_week[client_id]):
-                await self.active_connections[client_id].send_text(response.dump())
-
-    def update_client_target_week(self, client_id: str, target_week: datetime):
-        self.target_week[client_id] = target_week
\ No newline at end of file
+    async def send_response(self, connection_ids: list[uuid_pkg.UUID], response: ResponseBase) -> None:
+        # A week's snapshot supersedes the snapshots still queued for the client. Answers to a request are always
+        # sent, since clients pipeline their requests and wait for each response by its id.
+        snapshot = response.action == RequestActions.GetWeekOfActivities and response.status == ResponseStatus.SUCCESS \
+            and response.request_id is None
+        await self.send_payload(connection_ids, response.payload(), snapshot, reply=response.request_id is not None)
+
+    async def send_response_to_pool(self, schedule_id: uuid_pkg.UUID, response: ResponseBase, reply_to: uuid_pkg.UUID | None = None):
+        # Changes are published on the bus so that the clients connected to other processes are notified too.
+        # The bus delivers the event back to this process through handle_schedule_event. reply_to is the socket
+        # that made the change, for which the broadcast is the reply to its request.
+        week_spans = [week_span(start, end) for start, end in response.changed_ranges]
+        await self.bus.publish(ScheduleEvent(schedule_id, response.target_week, response.payload(), origin=self.bus.instance_id, \
+            week_spans=week_spans, reply_to=str(reply_to) if reply_to else None))
+
+    async def handle_schedule_event(self, event: ScheduleEvent):
+        # Changes made by another process didn't go through this process' cache
+        if event.origin != self.bus.instance_id:
+            self._invalidate_schedule_caches(event.schedule_id)
+
+        # Notify all sockets that are connected to the schedule and are currently viewing a week that's
+        # being updated, as well as the week the change was requested from. The socket that made the change
+        # always hears back, whichever week it is viewing, since the broadcast is the reply to its request.
+        week_rooms = self.rooms.get(event.schedule_id)
+        if not week_rooms:
+            return
+
+        target_key = week_key(event.target_week)
+        viewers = set()
+        for key, week_viewers in week_rooms.items():
+            if key == target_key or any(week_overlaps_span(key, span) for span in event.week_spans):
+                viewers.update(week_viewers)
+
+        requester = uuid_pkg.UUID(event.reply_to) if event.reply_to and event.origin == self.bus.instance_id else None
+        if self.client_schedule_connection.get(requester) != event.schedule_id:
+            requester = None
+        viewers.discard(requester)
+
+        if viewers or requester:
+            metrics.fan_out_recipients.observe(len(viewers) + (requester is not None))
+            with metrics.fan_out_enqueue_seconds.time():
+                if requester:
+                    await self.send_payload([requester], event.payload, reply=True)
+                await self.send_payload(list(viewers), event.payload)
+
+    def open_sockets(self) -> dict:
+        return {(str(schedule_id),) : sum(len(viewers) for viewers in week_rooms.values()) \
+            for schedule_id, week_rooms in self.rooms.items()}
+
+    def update_client_target_week(self, connection_id: uuid_pkg.UUID, target_week: datetime):
+        schedule_id = self.client_schedule_connection[connection_id]
+        # Key the week first, so a week that can't be keyed fails before the socket leaves its room
+        week_key(target_week)
+        self._leave_room(connection_id)
+        self.target_week[connection_id] = target_week
+        self._join_room(connection_id, schedule_id, target_week)
+        bookmark_store.record(self.connection_client[connection_id], schedule_id, target_week)
+
+    async def _snapshot(self, connection_id: uuid_pkg.UUID) -> Payload | None:
+        schedule_id = self.client_schedule_connection.get(connection_id)
+        if schedule_id is None:
+            return None
+
+        response = await db_executor.run(self._get_week_snapshot, schedule_id, self.target_week[connection_id])
+        return response.payload()
+
+    def _get_week_snapshot(self, schedule_id: uuid_pkg.UUID, target_week: datetime) -> ActivityResponse:
+        with Session(engine) as db_session:
+            return ScheduleService(db_session)._get_activities(schedule_id, target_week)
+
+    def _join_room(self, connection_id: uuid_pkg.UUID, schedule_id: uuid_pkg.UUID, target_week: datetime) -> None:
+        week = week_key(target_week)
+        self._follow(schedule_id)
+
+        week_rooms = self.rooms.setdefault(schedule_id, {})
+        week_rooms.setdefault(week, set()).add(connection_id)
+        self.connection_room[connection_id] = week
+
+    def _leave_room(self, connection_id: uuid_pkg.UUID) -> None:
+        schedule_id = self.client_schedule_connection.get(connection_id)
+        week = self.connection_room.pop(connection_id, None)
+        week_rooms = self.rooms.get(schedule_id)
+        if week_rooms is None or week is None:
+            return
+
+        viewers = week_rooms.get(week)
+        if viewers is not None:
+            viewers.discard(connection_id)
+            if not viewers:
+                del week_rooms[week]
+        
+        if not week_rooms:
+            del self.rooms[schedule_id]
+            self._unfollow(schedule_id)
+
+    def _follow(self, schedule_id: uuid_pkg.UUID) -> None:
+        if schedule_id not in self.rooms and schedule_id not in self.opening_connections:
+            self.bus.subscribe(schedule_id, self.handle_schedule_event)
+
+    def _unfollow(self, schedule_id: uuid_pkg.UUID) -> None:
+        if schedule_id in self.rooms or schedule_id in self.opening_connections:
+            return
+
+        # Without a subscription, changes from other processes would go unnoticed by the cache
+        self.bus.unsubscribe(schedule_id)
+        self._invalidate_schedule_caches(schedule_id)
+
+    def _invalidate_schedule_caches(self, schedule_id: uuid_pkg.UUID) -> None:
+        week_cache.invalidate_schedule(schedule_id)
+        interval_index.invalidate(schedule_id)
+        description_cache.invalidate_schedule(schedule_id)
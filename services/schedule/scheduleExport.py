@@ -0,0 +1,90 @@
+import csv
+import io
+import os
+import uuid as uuid_pkg
+from datetime import datetime
+from enum import Enum
+from typing import AsyncIterator
+
+from sqlalchemy import tuple_
+from sqlmodel import Session, select
+
+from database.database import db_executor, engine
+from database.models import Activity, ActivityDescription, Schedule
+from ..websocket.encoding import encode_json, serialize_activity
+
+# Activities read per query. Memory use is bounded by the page, however long the schedule is.
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", 500))
+
+class ExportFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.NDJSON : "application/x-ndjson",
+    ExportFormat.CSV : "text/csv",
+}
+
+CSV_COLUMNS = list(Activity.model_fields)
+
+def schedule_exists(schedule_id: uuid_pkg.UUID) -> bool:
+    with Session(engine) as db_session:
+        return db_session.exec(select(Schedule.id).where(Schedule.id == schedule_id)).one_or_none() is not None
+
+# Streams the schedule's activities ordered by (start, id), optionally only those within [start, end) in the
+# same way as a week is selected. Each page is read with keyset pagination in its own session, so no
+# connection is held while the client reads.
+async def stream_activities(schedule_id: uuid_pkg.UUID, start: datetime | None, end: datetime | None, export_format: ExportFormat, \
+    descriptions: bool) -> AsyncIterator[str]:
+    columns = CSV_COLUMNS + ["description"] if descriptions else CSV_COLUMNS
+    if export_format == ExportFormat.CSV:
+        yield _to_csv([columns])
+
+    after = None
+    while True:
+        page, after = await db_executor.run(_get_page, schedule_id, start, end, after, descriptions)
+        if not page:
+            return
+
+        if export_format == ExportFormat.CSV:
+            yield _to_csv([[activity.get(column) for column in columns] for activity in page])
+        else:
+            yield "".join(encode_json(activity) + "\n" for activity in page)
+
+        if len(page) < EXPORT_PAGE_SIZE:
+            return
+
+def _get_page(schedule_id: uuid_pkg.UUID, start: datetime | None, end: datetime | None, after: tuple | None, \
+    descriptions: bool) -> tuple[list[dict], tuple | None]:
+    with Session(engine) as db_session:
+        # Descriptions are joined into the page instead of being read one activity at a time
+        if descriptions:
+            query = select(Activity, ActivityDescription.text).outerjoin(ActivityDescription, ActivityDescription.activity_id == Activity.id)
+        else:
+            query = select(Activity)
+
+        query = query.where(Activity.schedule_id == schedule_id)
+        if start:
+            query = query.where(Activity.start >= start)
+        if end:
+            query = query.where(Activity.end < end)
+        if after:
+            query = query.where(tuple_(Activity.start, Activity.id) > after)
+
+        rows_db = db_session.exec(query.order_by(Activity.start, Activity.id).limit(EXPORT_PAGE_SIZE)).all()
+
+    if not rows_db:
+        return [], None
+
+    if descriptions:
+        page = [{**serialize_activity(activity_db), "description" : text} for activity_db, text in rows_db]
+        last_db = rows_db[-1][0]
+    else:
+        page = [serialize_activity(activity_db) for activity_db in rows_db]
+        last_db = rows_db[-1]
+    return page, (last_db.start, last_db.id)
+
+def _to_csv(rows: list[list]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
@@ -0,0 +1,196 @@
+import csv
+import io
+import json
+import os
+import tempfile
+import uuid as uuid_pkg
+from datetime import datetime
+from enum import Enum
+from typing import IO, Iterator
+
+from sqlalchemy import insert
+from sqlmodel import Session, select
+
+from database.database import engine
+from database.models import Activity, ActivityDescription, Schedule
+from .intervalIndex import interval_index
+from .scheduleCache import description_cache, week_cache
+from .scheduleService import ScheduleService
+from ..websocket.encoding import parse_timestamp, serialize_activity
+
+# Rows inserted per executemany
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 1000))
+
+# Rows accepted per import. The parsed rows are held in memory for the overlap check.
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", 20000))
+
+# Request bodies larger than this are spooled to disk while they are read
+IMPORT_SPOOL_BYTES = 1024 * 1024
+
+class ImportFormat(str, Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+    # A JSON array of rows. Unlike the other formats it is parsed in one piece.
+    JSON = "json"
+
+class ImportTooLarge(Exception):
+    pass
+
+def create_spool() -> IO[bytes]:
+    return tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_BYTES)
+
+# Imports the rows of a CSV or JSON file into the schedule in one transaction. Rows that fail to parse or
+# overlap another activity are reported and skipped, the rest are inserted. Returns None if the schedule
+# doesn't exist, otherwise the report and the inserted activities.
+def import_activities(schedule_id: uuid_pkg.UUID, upload: IO[bytes], import_format: ImportFormat) -> tuple[dict, list[dict]] | None:
+    errors = []
+    rows = []
+    seen_ids = set()
+    for row_number, raw_row in enumerate(_read_rows(upload, import_format), start=1):
+        if row_number > IMPORT_MAX_ROWS:
+            raise ImportTooLarge(f"Imports are limited to {IMPORT_MAX_ROWS} rows")
+
+        try:
+            row = _parse_row(schedule_id, raw_row)
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append({"row" : row_number, "error" : _describe_error(e)})
+            continue
+
+        if row["id"] in seen_ids:
+            errors.append({"row" : row_number, "error" : "Duplicate id"})
+            continue
+        seen_ids.add(row["id"])
+        rows.append((row_number, row))
+
+    with Session(engine) as db_session:
+        if db_session.get(Schedule, schedule_id) is None:
+            return None
+
+        if not rows:
+            return _report(0, None, errors), []
+
+        # The update locks the schedule's row, so the activities read below can't change until the commit
+        change_seq = ScheduleService(db_session)._next_change_seq(schedule_id)
+
+        existing_ids = set()
+        row_ids = [row["id"] for _, row in rows]
+        for i in range(0, len(row_ids), IMPORT_CHUNK_SIZE):
+            existing_ids.update(db_session.exec(select(Activity.id).where(Activity.id.in_(row_ids[i:i + IMPORT_CHUNK_SIZE]))).all())
+
+        existing_intervals = sorted(db_session.exec(select(Activity.start, Activity.end).where(Activity.schedule_id == schedule_id)).all())
+        accepted = []
+        for row_number, row, error in _sweep(rows, existing_intervals):
+            if error is None and row["id"] in existing_ids:
+                error = "An activity with this id already exists"
+            if error:
+                errors.append({"row" : row_number, "error" : error})
+            else:
+                row["change_seq"] = change_seq
+                accepted.append(row)
+
+        if not accepted:
+            db_session.rollback()
+            return _report(0, None, errors), []
+
+        for i in range(0, len(accepted), IMPORT_CHUNK_SIZE):
+            chunk = accepted[i:i + IMPORT_CHUNK_SIZE]
+            db_session.connection().execute(insert(Activity), [{key : value for key, value in row.items() if key != "description"} \
+                for row in chunk])
+            descriptions = [{"activity_id" : row["id"], "text" : row["description"]} for row in chunk if row.get("description")]
+            if descriptions:
+                db_session.connection().execute(insert(ActivityDescription), descriptions)
+
+        db_session.commit()
+
+    week_cache.invalidate_schedule(schedule_id)
+    interval_index.invalidate(schedule_id)
+    description_cache.invalidate_activities([row["id"] for row in accepted])
+
+    errors.sort(key=lambda error: error["row"])
+    activities = [serialize_activity(Activity(**{key : value for key, value in row.items() if key != "description"})) for row in accepted]
+    return _report(len(accepted), change_seq, errors), activities
+
+# Checks the rows for overlaps with the existing activities and with each other in one pass over both sorted by
+# start. When rows overlap each other the earliest is kept. Yields (row_number, row, error) in start order.
+def _sweep(rows: list[tuple[int, dict]], existing_intervals: list[tuple[datetime, datetime]]) -> Iterator[tuple[int, dict, str | None]]:
+    j = 0
+    previous_end, previous_row = None, None
+    for row_number, row in sorted(rows, key=lambda item: (item[1]["start"], item[1]["end"], item[0])):
+        start, end = row["start"], row["end"]
+
+        # The latest end of everything kept so far that starts before this row
+        while j < len(existing_intervals) and existing_intervals[j][0] < start:
+            if previous_end is None or existing_intervals[j][1] > previous_end:
+                previous_end, previous_row = existing_intervals[j][1], None
+            j += 1
+
+        if previous_end is not None and previous_end > start:
+            yield row_number, row, f"Overlaps row {previous_row}" if previous_row else "Overlaps an existing activity"
+            continue
+
+        # Existing activities that start within the row
+        k = j
+        overlaps_existing = False
+        while k < len(existing_intervals) and existing_intervals[k][0] < end:
+            if existing_intervals[k][1] > start:
+                overlaps_existing = True
+                break
+            k += 1
+
+        if overlaps_existing:
+            yield row_number, row, "Overlaps an existing activity"
+            continue
+
+        if previous_end is None or end > previous_end:
+            previous_end, previous_row = end, row_number
+        yield row_number, row, None
+
+def _read_rows(upload: IO[bytes], import_format: ImportFormat) -> Iterator[dict | str]:
+    text = io.TextIOWrapper(upload, encoding="utf-8-sig", newline="")
+    if import_format == ImportFormat.CSV:
+        yield from csv.DictReader(text)
+    elif import_format == ImportFormat.NDJSON:
+        # Lines are decoded with the rest of the row, so a malformed line only fails its own row
+        for line in text:
+            if line.strip():
+                yield line
+    else:
+        rows = json.load(text)
+        if not isinstance(rows, list):
+            raise ValueError("Expected a JSON array of activities")
+        yield from rows
+
+def _parse_row(schedule_id: uuid_pkg.UUID, raw_row: dict | str) -> dict:
+    if isinstance(raw_row, str):
+        raw_row = json.loads(raw_row)
+    if not isinstance(raw_row, dict):
+        raise TypeError("Expected an object")
+
+    # Empty CSV cells are missing values
+    raw_row = {key : value for key, value in raw_row.items() if value not in ("", None)}
+    row = {
+        "id" : uuid_pkg.UUID(str(raw_row["id"])) if "id" in raw_row else uuid_pkg.uuid4(),
+        "schedule_id" : schedule_id,
+        "title" : str(raw_row["title"]),
+        "type" : str(raw_row.get("type", "Default")),
+        "cost" : raw_row.get("cost"),
+        "start" : parse_timestamp(raw_row["start"]),
+        "end" : parse_timestamp(raw_row["end"]),
+        "location" : str(raw_row["location"]),
+        "local_timezone" : int(raw_row.get("local_timezone", 0)),
+        "dest_location" : raw_row.get("dest_location"),
+        "version" : 0,
+        "description" : raw_row.get("description"),
+    }
+
+    if row["start"] > row["end"]:
+        raise ValueError("Start is after end")
+    return row
+
+def _describe_error(e: Exception) -> str:
+    if isinstance(e, KeyError):
+        return f"Missing {e.args[0]}"
+    return str(e)
+
+def _report(imported: int, change_seq: int | None, errors: list[dict]) -> dict:
+    return {"imported" : imported, "change_seq" : change_seq, "errors" : errors}
@@ -1,62 +1,201 @@
+import uuid as uuid_pkg
 from datetime import datetime, timedelta
-from sqlmodel import Session, func, select
+from sqlalchemy import and_
+from sqlmodel import Session, select, update
  
-from database.models import Activity, ActivityDescription
+from database.database import db_executor, engine
+from database.models import Activity, ActivityDescription, ActivityTombstone, Schedule, ScheduleBookmark
+from .bookmarkStore import bookmark_store
 from .requestActions import RequestActions
+from .intervalIndex import ScheduleIntervals, interval_index
+from .scheduleCache import NO_DESCRIPTION, description_cache, week_cache
+from .utilities import get_start_date_of_week
+from ..monitoring import metrics
+from ..websocket.encoding import serialize_activity
 from ..websocket.responseStatus import ResponseStatus
-from ..websocket.protocols import DescriptionResponse, ActivityResponse, Request, ResponseBase
+from ..websocket.protocols import BatchResponse, DescriptionResponse, ActivityResponse, Request, ResponseBase, SyncResponse
+
+MAX_BATCH_OPERATIONS = 500
+
+# Clients that are further behind than this are told to reload instead of catching up
+MAX_SYNC_CHANGES = 1000
 
 class ScheduleService:
     def __init__(self, db_session: Session):
         self.db_session = db_session
 
-    def get_response(self, schedule_id : str, request: Request) -> ResponseBase:
+    # The session is blocking, so all of the work is done on the database executor. Each call is a unit of work
+    # with a session of its own, so a socket only holds a connection while one of its requests runs and the
+    # requests of a connection can run concurrently.
+    @staticmethod
+    async def get_response(schedule_id: uuid_pkg.UUID, request: Request) -> ResponseBase:
+        return await db_executor.run(ScheduleService._run_in_session, ScheduleService._get_response, schedule_id, request)
+
+    @staticmethod
+    async def get_activities(schedule_id: uuid_pkg.UUID, target_week: datetime) -> ActivityResponse:
+        return await db_executor.run(ScheduleService._run_in_session, ScheduleService._get_activities, schedule_id, target_week)
+
+    @staticmethod
+    async def sync_activities(schedule_id: uuid_pkg.UUID, since_seq: int, request_id: str | None = None) -> SyncResponse:
+        return await db_executor.run(ScheduleService._run_in_session, ScheduleService._sync_activities, schedule_id, since_seq, request_id)
+
+    @staticmethod
+    async def bootstrap(client_id: uuid_pkg.UUID, schedule_id: uuid_pkg.UUID) -> ActivityResponse | None:
+        return await db_executor.run(ScheduleService._run_in_session, ScheduleService._bootstrap, client_id, schedule_id, \
+            bookmark_store.get(client_id, schedule_id))
+
+    @staticmethod
+    def _run_in_session(method, *args):
+        with Session(engine) as db_session:
+            response = method(ScheduleService(db_session), *args)
+
+            # Responses can hold activities of the session, so they are serialized before it closes
+            if response is not None:
+                response.payload()
+            return response
+
+    def _get_response(self, schedule_id: uuid_pkg.UUID, request: Request) -> ResponseBase:
         if request.action not in [e.value for e in RequestActions]:
             return ResponseBase(status=ResponseStatus.INVALID, action=request.action, request_id=request.id)
 
+        with metrics.action_seconds.labels(request.action).time():
+            return self._handle_request(schedule_id, request)
+
+    def _handle_request(self, schedule_id: uuid_pkg.UUID, request: Request) -> ResponseBase:
         if request.action == RequestActions.GetWeekOfActivities:
-            return self.get_activities(schedule_id=schedule_id, target_week=request.target_week)
+            return self._get_activities(schedule_id=schedule_id, target_week=request.target_week, request_id=request.id, \
+                include_descriptions=request.include_descriptions)
         elif request.action == RequestActions.GetActivity:
-            return self.get_activity(request)
+            return self._get_activity(request)
         elif request.action == RequestActions.UpdateActivity:
-            return self.update_activity(request)
+            return self._update_activity(request)
         elif request.action == RequestActions.CreateActivity:
-            return self.create_activity(request)
+            return self._create_activity(request)
         elif request.action == RequestActions.DeleteActivity:
-            return self.delete_activity(request)
+            return self._delete_activity(request)
+        elif request.action == RequestActions.BatchActivities:
+            return self._apply_batch(request)
+        elif request.action == RequestActions.SyncActivities:
+            return self._sync_activities(schedule_id, request.since_seq, request.id)
 
-    def get_activities(self, schedule_id: str, target_week: datetime) -> ActivityResponse:
+    def _get_activities(self, schedule_id: uuid_pkg.UUID, target_week: datetime, request_id: str | None = None, \
+        include_descriptions: bool = False) -> ActivityResponse:
         try:
-            end_of_target_week = target_week + timedelta(weeks=1)
-            activities_db = self.db_session.exec(select(Activity).where(Activity.schedule_id == schedule_id, \
-                Activity.start >= target_week, Activity.end < end_of_target_week).order_by(Activity.start)).all()
+            cached_week = week_cache.get_week(schedule_id, target_week)
+            if cached_week is not None:
+                change_seq, cached_activities = cached_week
+                activities = list(cached_activities)
+            else:
+                generation = week_cache.generation(schedule_id)
+                # The change_seq is read in the same statement as the week, so the two are consistent
+                end_of_target_week = target_week + timedelta(weeks=1)
+                rows_db = self.db_session.exec(select(Schedule.change_seq, Activity).outerjoin(Activity, and_(Activity.schedule_id == Schedule.id, \
+                    Activity.start >= target_week, Activity.end < end_of_target_week)).where(Schedule.id == schedule_id).order_by(Activity.start)).all()
+                change_seq = rows_db[0][0] if rows_db else None
+                activities = [serialize_activity(activity_db) for _, activity_db in rows_db if activity_db is not None]
+                week_cache.put_week(schedule_id, target_week, change_seq, activities, generation)
+
+            # Clients that are about to open the week's activities can have their descriptions sent along
+            descriptions = self._get_descriptions([activity["id"] for activity in activities]) if include_descriptions else None
         except:
-            return ActivityResponse(status=ResponseStatus.SERVER_ERROR, action=RequestActions.GetWeekOfActivities, target_week=target_week)
+            return ActivityResponse(status=ResponseStatus.SERVER_ERROR, action=RequestActions.GetWeekOfActivities, target_week=target_week, request_id=request_id)
         else: 
-            return ActivityResponse(status=ResponseStatus.SUCCESS, action=RequestActions.GetWeekOfActivities, target_week=target_week, activities=activities_db)
+            return ActivityResponse(status=ResponseStatus.SUCCESS, action=RequestActions.GetWeekOfActivities, target_week=target_week, \
+                activities=activities, request_id=request_id, change_seq=change_seq, descriptions=descriptions)
+
+    def _bootstrap(self, client_id: uuid_pkg.UUID, schedule_id: uuid_pkg.UUID, target_week: datetime | None) -> ActivityResponse | None:
+        # Resolve the week the client starts on and load it. None if the schedule doesn't exist.
+        if target_week is None:
+            target_week = self._get_initial_target_week(client_id, schedule_id)
+            if target_week is None:
+                return None
+
+        return self._get_activities(schedule_id, target_week)
+
+    def _get_initial_target_week(self, client_id: uuid_pkg.UUID, schedule_id: uuid_pkg.UUID) -> datetime | None:
+        # The week the client was last on, else the week of the schedule's earliest activity, else the schedule's
+        # first week. All three are read in a single query.
+        bookmark_week = select(ScheduleBookmark.week_start).where(ScheduleBookmark.user_id == client_id, \
+            ScheduleBookmark.schedule_id == Schedule.id).scalar_subquery()
+        earliest_activity = select(Activity).where(Activity.schedule_id == Schedule.id).order_by(Activity.start).limit(1)
+        earliest_start = earliest_activity.with_only_columns(Activity.start).scalar_subquery()
+        earliest_timezone = earliest_activity.with_only_columns(Activity.local_timezone).scalar_subquery()
+        summary_db = self.db_session.exec(select(bookmark_week, earliest_start, earliest_timezone, Schedule.init_week_start, \
+            Schedule.init_timezone_offset).where(Schedule.id == schedule_id)).one_or_none()
+
+        if not summary_db:
+            return None
+
+        # Weeks start on Monday in the timezone of the activity or schedule they are found from
+        week_start_db, earliest_start_db, earliest_timezone_db, schedule_start_db, schedule_timezone_db = summary_db
+        if week_start_db:
+            return week_start_db
+        elif earliest_start_db:
+            return get_start_date_of_week(earliest_start_db, earliest_timezone_db)
+        else:
+            return get_start_date_of_week(schedule_start_db, schedule_timezone_db)
+
+    def _sync_activities(self, schedule_id: uuid_pkg.UUID, since_seq: int | None, request_id: str | None) -> SyncResponse:
+        action = RequestActions.SyncActivities
+        if since_seq is None or since_seq < 0:
+            return SyncResponse(status=ResponseStatus.INVALID, action=action, request_id=request_id)
+
+        try:
+            change_seq = self._get_change_seq(schedule_id)
+            if change_seq is None:
+                return SyncResponse(status=ResponseStatus.NOT_FOUND, action=action, request_id=request_id)
+
+            # A client that is ahead of the schedule has stale state from somewhere else
+            if since_seq > change_seq:
+                return SyncResponse(status=ResponseStatus.EXPIRED, action=action, change_seq=change_seq, request_id=request_id)
+
+            activities_db = self.db_session.exec(select(Activity).where(Activity.schedule_id == schedule_id, \
+                Activity.change_seq > since_seq).order_by(Activity.change_seq).limit(MAX_SYNC_CHANGES + 1)).all()
+            deleted_activity_ids = self.db_session.exec(select(ActivityTombstone.activity_id).where(ActivityTombstone.schedule_id == schedule_id, \
+                ActivityTombstone.change_seq > since_seq).limit(MAX_SYNC_CHANGES + 1)).all()
+
+            if len(activities_db) + len(deleted_activity_ids) > MAX_SYNC_CHANGES:
+                return SyncResponse(status=ResponseStatus.EXPIRED, action=action, change_seq=change_seq, request_id=request_id)
 
-    def get_activity(self, request: Request) -> DescriptionResponse:
+            activities = [serialize_activity(activity_db) for activity_db in activities_db]
+
+            # Activities that were created again after they were deleted are sent as they are now
+            live_activity_ids = {activity["id"] for activity in activities}
+            deleted_activity_ids = [activity_id for activity_id in deleted_activity_ids if str(activity_id) not in live_activity_ids]
+        except:
+            return SyncResponse(status=ResponseStatus.SERVER_ERROR, action=action, request_id=request_id)
+        else:
+            return SyncResponse(status=ResponseStatus.SUCCESS, action=action, change_seq=change_seq, activities=activities, \
+                deleted_activity_ids=[str(activity_id) for activity_id in deleted_activity_ids], request_id=request_id)
+
+    def _get_activity(self, request: Request) -> DescriptionResponse:
         try: 
             activity_id = request.activity_id
             if not activity_id:
                 return DescriptionResponse(status=ResponseStatus.INVALID, action=request.action, activity_id=activity_id, request_id=request.id)
 
-            description_db = self.db_session.get(ActivityDescription, activity_id)
-            if not description_db:
+            description = self._get_descriptions([activity_id]).get(str(activity_id))
+            if description is None:
                 return DescriptionResponse(status=ResponseStatus.NOT_FOUND, action=request.action, activity_id=activity_id, request_id=request.id)
         except:
             return DescriptionResponse(status=ResponseStatus.SERVER_ERROR, action=request.action, activity_id=activity_id, request_id=request.id)
         else:
             return DescriptionResponse(status=ResponseStatus.SUCCESS, action=request.action, activity_id=activity_id, \
-                description=description_db.text, request_id=request.id)
+                description=description, request_id=request.id)
 
-    def create_activity(self, request: Request) -> ActivityResponse:
+    def _create_activity(self, request: Request) -> ActivityResponse:
         try: 
             activity = request.activity
             if not activity: 
                 return ActivityResponse(ResponseStatus.INVALID, action=request.action, target_week=request.target_week, request_id=request.id)
 
-            if activity.start > activity.end or self.check_if_activity_overlaps_others(activity):
+            if activity.start > activity.end:
+                return ActivityResponse(ResponseStatus.INVALID, action=request.action, target_week=request.target_week, request_id=request.id)
+
+            # The schedule is locked before the overlap check, so nothing can be committed to it in between
+            activity.change_seq = self._next_change_seq(activity.schedule_id)
+            if self._check_if_activity_overlaps_others(activity, activity.change_seq - 1):
+                self.db_session.rollback()
                 return ActivityResponse(ResponseStatus.INVALID, action=request.action, target_week=request.target_week, request_id=request.id)
  
             # Add the activity
@@ -68,33 +207,48 @@ class ScheduleService:
                 self.db_session.add(activity_description_db)
 
             self.db_session.commit()
+            week_cache.invalidate_activity(activity.schedule_id, activity.start, activity.end)
+            interval_index.apply(activity.schedule_id, activity.change_seq, [(activity.id, (activity.start, activity.end))])
+            description_cache.invalidate_activities([activity.id])
             self.db_session.refresh(activity)
         except:
             return ActivityResponse(status=ResponseStatus.SERVER_ERROR, action=request.action, target_week=request.target_week, request_id=request.id)
         else: 
-            return ActivityResponse(status=ResponseStatus.SUCCESS, action=request.action, target_week=request.target_week, activities=[activity], request_id=request.id)
+            return ActivityResponse(status=ResponseStatus.SUCCESS, action=request.action, target_week=request.target_week, activities=[activity], request_id=request.id, \
+                change_seq=activity.change_seq, changed_ranges=[(activity.start, activity.end)])
 
-    def delete_activity(self, request: Request) -> ActivityResponse:
+    def _delete_activity(self, request: Request) -> ActivityResponse:
+        activity_db = None
         try:
             if not request.activity_id:
                 return ActivityResponse(status=ResponseStatus.INVALID, action=request.action, target_week=request.target_week, request_id=request.id)
 
             # Check if activity exists
-            activity_db = self.db_session.get(Activity, request.activity.id)
+            activity_db = self.db_session.get(Activity, request.activity_id)
             if not activity_db:
                 return ActivityResponse(status=ResponseStatus.NOT_FOUND, action=request.action, target_week=request.target_week, request_id=request.id)
 
+            change_seq = self._next_change_seq(activity_db.schedule_id)
             self.db_session.delete(activity_db)
+            # An activity that was deleted before and created again with the same id already has a tombstone
+            self.db_session.merge(ActivityTombstone(activity_id=activity_db.id, schedule_id=activity_db.schedule_id, change_seq=change_seq))
             self.db_session.commit()
+            week_cache.invalidate_activity(activity_db.schedule_id, activity_db.start, activity_db.end)
+            interval_index.apply(activity_db.schedule_id, change_seq, [(activity_db.id, None)])
+            description_cache.invalidate_activities([activity_db.id])
         except:
+            # The rollback lets the activity be reloaded as it is in the database
+            self.db_session.rollback()
             response = ActivityResponse(status=ResponseStatus.SERVER_ERROR, action=request.action, target_week=request.target_week, request_id=request.id)
             if activity_db:
                 response.activities.append(activity_db)
             return response
         else:
-            return ActivityResponse(status=ResponseStatus.SUCCESS, action=request.action, target_week=request.target_week, request_id=request.id)
+            return ActivityResponse(status=ResponseStatus.SUCCESS, action=request.action, target_week=request.target_week, request_id=request.id, \
+                change_seq=change_seq, changed_ranges=[(activity_db.start, activity_db.end)])
     
-    def update_activity(self, request: Request) -> ActivityResponse:
+    def _update_activity(self, request: Request) -> ActivityResponse:
+        activity_db = None
         try: 
             activity = request.activity
             if not activity or not activity.id: 
@@ -104,34 +258,226 @@ class ScheduleService:
             if not activity_db:
                 return ActivityResponse(status=ResponseStatus.NOT_FOUND, action=request.action, target_week=request.target_week, request_id=request.id)
 
+            # The schedule is locked before the checks, so nothing can be committed to it in between. The activity
+            # is read again in case it changed before the lock was taken.
+            change_seq = self._next_change_seq(activity_db.schedule_id)
+            self.db_session.refresh(activity_db)
+
             # Clients are responsible for incrementing the version each time they edit. If a client attempts to submit edit version n
             # but edit version m >= n was already processed, the request is discarded because edit version n was working with old values.
             # Successful edits are broadcasted, this is how clients know which version the activity is on.
             if activity_db.version >= activity.version:
+                self.db_session.rollback()
                 return ActivityResponse(status=ResponseStatus.EXPIRED, action=request.action, target_week=request.target_week, activities=[activity_db], request_id=request.id)
 
-            if activity.start > activity.end or self.check_if_activity_overlaps_others(activity):
+            if activity.start > activity.end or self._check_if_activity_overlaps_others(activity, change_seq - 1):
+                self.db_session.rollback()
                 return ActivityResponse(ResponseStatus.INVALID, action=request.action, target_week=request.target_week, activities=[activity_db], request_id=request.id)
             
+            previous_start, previous_end = activity_db.start, activity_db.end
             activity_db.sqlmodel_update(activity)
+            activity_db.change_seq = change_seq
             self.db_session.add(activity_db)
 
-            # Add the description
+            # Add or replace the description
             if request.description:
-                activity_description_db = ActivityDescription(activity_id=activity.id, text=request.description)
-                self.db_session.add(activity_description_db)
+                self.db_session.merge(ActivityDescription(activity_id=activity.id, text=request.description))
 
             self.db_session.commit()
+            if request.description:
+                description_cache.invalidate_activities([activity.id])
+            week_cache.invalidate_activity(activity_db.schedule_id, previous_start, previous_end)
+            week_cache.invalidate_activity(activity_db.schedule_id, activity.start, activity.end)
+            interval_index.apply(activity_db.schedule_id, change_seq, [(activity_db.id, (activity.start, activity.end))])
             self.db_session.refresh(activity_db)
         except:
+            # The rollback lets the activity be reloaded as it is in the database
+            self.db_session.rollback()
             response = ActivityResponse(status=ResponseStatus.SERVER_ERROR, action=request.action, target_week=request.target_week, request_id=request.id)
             if activity_db:
                 response.activities.append(activity_db)
             return response
         else: 
-            return ActivityResponse(status=ResponseStatus.SUCCESS, action=request.action, target_week=request.target_week, activities=[activity_db], request_id=request.id)
+            return ActivityResponse(status=ResponseStatus.SUCCESS, action=request.action, target_week=request.target_week, activities=[activity_db], request_id=request.id, \
+                change_seq=activity_db.change_seq, changed_ranges=[(previous_start, previous_end), (activity_db.start, activity_db.end)])
     
-    def check_if_activity_overlaps_others(self, activity: Activity) -> bool:
-        collision_count = self.db_session.exec(select(func.count(Activity.id)).where(Activity.schedule_id == activity.schedule_id, \
-            Activity.start < activity.end, Activity.end > activity.start, Activity.id != activity.id)).one()
-        return collision_count > 0
\ No newline at end of file
+    def _apply_batch(self, request: Request) -> BatchResponse:
+        if not request.operations or len(request.operations) > MAX_BATCH_OPERATIONS:
+            return BatchResponse(status=ResponseStatus.INVALID, action=request.action, target_week=request.target_week, results=[], \
+                activities=[], deleted_activity_ids=[], request_id=request.id)
+
+        results = []
+        changed_activities = {}
+        deleted_activity_ids = []
+
+        # The time ranges each applied operation touched, as (schedule_id, activity_id, previous range, new range).
+        changed_ranges = []
+
+        # Operations are validated against the schedule as it would be after the earlier operations of the batch, so
+        # the overlap checks run against a working copy of the schedule's intervals. Each schedule is locked before
+        # its intervals are read, and the whole batch is one change to each schedule it touches.
+        change_seqs = {}
+        working_intervals = {}
+        def get_working_intervals(schedule_id):
+            if str(schedule_id) not in working_intervals:
+                change_seqs[str(schedule_id)] = self._next_change_seq(schedule_id)
+                working_intervals[str(schedule_id)] = self._get_schedule_intervals(schedule_id, change_seqs[str(schedule_id)] - 1).copy()
+            return working_intervals[str(schedule_id)]
+
+        try:
+            for operation in request.operations:
+                status = self._apply_batch_operation(operation, get_working_intervals, changed_activities, deleted_activity_ids, changed_ranges)
+                results.append(ResponseBase(status=status, action=operation.action, request_id=operation.id))
+
+            if not changed_ranges:
+                self.db_session.rollback()
+                return BatchResponse(status=ResponseStatus.INVALID, action=request.action, target_week=request.target_week, results=results, \
+                    activities=[], deleted_activity_ids=[], request_id=request.id)
+
+            for schedule_id, activity_id, previous_range, new_range in changed_ranges:
+                if not new_range:
+                    self.db_session.merge(ActivityTombstone(activity_id=activity_id, schedule_id=schedule_id, change_seq=change_seqs[str(schedule_id)]))
+            for activity in changed_activities.values():
+                activity.change_seq = change_seqs[str(activity.schedule_id)]
+
+            # Serialize before committing, otherwise every activity would be reloaded after the commit expires it.
+            activities = [serialize_activity(activity) for activity in changed_activities.values()]
+            self.db_session.commit()
+        except:
+            self.db_session.rollback()
+            return BatchResponse(status=ResponseStatus.SERVER_ERROR, action=request.action, target_week=request.target_week, \
+                results=[ResponseBase(status=ResponseStatus.SERVER_ERROR, action=operation.action, request_id=operation.id) for operation in request.operations], \
+                activities=[], deleted_activity_ids=[], request_id=request.id)
+
+        description_cache.invalidate_activities([activity_id for _, activity_id, _, _ in changed_ranges])
+        for schedule_id, activity_id, previous_range, new_range in changed_ranges:
+            if previous_range:
+                week_cache.invalidate_activity(schedule_id, *previous_range)
+            if new_range:
+                week_cache.invalidate_activity(schedule_id, *new_range)
+        for schedule_id, change_seq in change_seqs.items():
+            interval_index.apply(schedule_id, change_seq, [(activity_id, new_range) for changed_schedule_id, activity_id, _, new_range in changed_ranges \
+                if str(changed_schedule_id) == schedule_id])
+
+        return BatchResponse(status=ResponseStatus.SUCCESS, action=request.action, target_week=request.target_week, results=results, \
+            activities=activities, deleted_activity_ids=deleted_activity_ids, request_id=request.id, change_seq=max(change_seqs.values(), default=None), \
+            changed_ranges=[time_range for _, _, previous_range, new_range in changed_ranges for time_range in (previous_range, new_range) if time_range])
+
+    def _apply_batch_operation(self, operation: Request, get_working_intervals, changed_activities: dict, deleted_activity_ids: list, \
+        changed_ranges: list) -> ResponseStatus:
+        if operation.action == RequestActions.CreateActivity:
+            activity = operation.activity
+            if not activity:
+                return ResponseStatus.INVALID
+
+            intervals = get_working_intervals(activity.schedule_id)
+            if activity.start > activity.end or intervals.overlaps(activity.start, activity.end, activity.id):
+                return ResponseStatus.INVALID
+
+            self.db_session.add(activity)
+            if operation.description:
+                self.db_session.add(ActivityDescription(activity_id=activity.id, text=operation.description))
+
+            intervals.add(activity.id, activity.start, activity.end)
+            changed_activities[str(activity.id)] = activity
+            changed_ranges.append((activity.schedule_id, activity.id, None, (activity.start, activity.end)))
+            return ResponseStatus.SUCCESS
+
+        elif operation.action == RequestActions.UpdateActivity:
+            activity = operation.activity
+            if not activity or not activity.id:
+                return ResponseStatus.INVALID
+
+            activity_db = self.db_session.get(Activity, activity.id)
+            if not activity_db or str(activity_db.id) in deleted_activity_ids:
+                return ResponseStatus.NOT_FOUND
+
+            # An activity read before its schedule was locked is read again, in case it changed in between
+            if str(activity_db.schedule_id) not in working_intervals:
+                get_working_intervals(activity_db.schedule_id)
+                self.db_session.refresh(activity_db)
+
+            # See update_activity for how versions are used
+            if activity_db.version >= activity.version:
+                return ResponseStatus.EXPIRED
+
+            intervals = get_working_intervals(activity_db.schedule_id)
+            if activity.start > activity.end or intervals.overlaps(activity.start, activity.end, activity.id):
+                return ResponseStatus.INVALID
+
+            previous_range = (activity_db.start, activity_db.end)
+            activity_db.sqlmodel_update(activity)
+            self.db_session.add(activity_db)
+            if operation.description:
+                self.db_session.merge(ActivityDescription(activity_id=activity.id, text=operation.description))
+
+            intervals.add(activity_db.id, activity.start, activity.end)
+            changed_activities[str(activity_db.id)] = activity_db
+            changed_ranges.append((activity_db.schedule_id, activity_db.id, previous_range, (activity.start, activity.end)))
+            return ResponseStatus.SUCCESS
+
+        elif operation.action == RequestActions.DeleteActivity:
+            if not operation.activity_id:
+                return ResponseStatus.INVALID
+
+            activity_db = self.db_session.get(Activity, operation.activity_id)
+            if not activity_db or str(activity_db.id) in deleted_activity_ids:
+                return ResponseStatus.NOT_FOUND
+
+            self.db_session.delete(activity_db)
+
+            get_working_intervals(activity_db.schedule_id).remove(activity_db.id)
+            changed_activities.pop(str(activity_db.id), None)
+            deleted_activity_ids.append(str(activity_db.id))
+            changed_ranges.append((activity_db.schedule_id, activity_db.id, (activity_db.start, activity_db.end), None))
+            return ResponseStatus.SUCCESS
+
+        return ResponseStatus.INVALID
+
+    def _get_descriptions(self, activity_ids: list) -> dict[str, str]:
+        # The descriptions of the activities that have one. Those that aren't cached are read in one IN query.
+        descriptions = {}
+        missing_ids = []
+        for activity_id in activity_ids:
+            description = description_cache.get_description(activity_id)
+            if description is None:
+                missing_ids.append(str(activity_id))
+            elif description != NO_DESCRIPTION:
+                descriptions[str(activity_id)] = description
+
+        if missing_ids:
+            generation = description_cache.generation()
+            # Descriptions are cached along with their activity's schedule, so that they can be dropped with the
+            # schedule's other caches. Activities that don't exist aren't cached, since they have no schedule.
+            descriptions_db = self.db_session.exec(select(Activity.id, Activity.schedule_id, ActivityDescription.text) \
+                .outerjoin(ActivityDescription, ActivityDescription.activity_id == Activity.id) \
+                .where(Activity.id.in_([uuid_pkg.UUID(activity_id) for activity_id in missing_ids]))).all()
+
+            loaded = {str(activity_id) : (schedule_id, text or NO_DESCRIPTION) for activity_id, schedule_id, text in descriptions_db}
+            description_cache.put_descriptions(loaded, generation)
+            descriptions.update({activity_id : text for activity_id, (_, text) in loaded.items() if text != NO_DESCRIPTION})
+
+        return descriptions
+
+    def _get_change_seq(self, schedule_id: uuid_pkg.UUID) -> int | None:
+        return self.db_session.exec(select(Schedule.change_seq).where(Schedule.id == schedule_id)).one_or_none()
+
+    def _next_change_seq(self, schedule_id: uuid_pkg.UUID) -> int:
+        # The row lock taken by the update orders concurrent changes to the schedule until the transaction commits
+        return self.db_session.exec(update(Schedule).where(Schedule.id == schedule_id).values(change_seq=Schedule.change_seq + 1) \
+            .returning(Schedule.change_seq)).scalar_one()
+
+    def _check_if_activity_overlaps_others(self, activity: Activity, change_seq: int) -> bool:
+        return self._get_schedule_intervals(activity.schedule_id, change_seq).overlaps(activity.start, activity.end, activity.id)
+
+    def _get_schedule_intervals(self, schedule_id: uuid_pkg.UUID, change_seq: int) -> ScheduleIntervals:
+        # The intervals of the schedule at change_seq. The caller holds the schedule's row lock, so change_seq is the
+        # last committed change and the intervals are reloaded if the index hasn't caught up with it, e.g. because
+        # the change was made by another process.
+        intervals = interval_index.get_intervals(schedule_id, change_seq)
+        if intervals is None:
+            generation = interval_index.generation(schedule_id)
+            intervals_db = self.db_session.exec(select(Activity.start, Activity.end, Activity.id).where(Activity.schedule_id == schedule_id)).all()
+            intervals = ScheduleIntervals(intervals_db, change_seq)
+            interval_index.put_intervals(schedule_id, intervals, generation)
+        return intervals
@@ -1,11 +1,36 @@
 from datetime import datetime, timedelta
 
-def are_dates_in_same_week(date1: datetime, date2: datetime) -> bool:
-    # TODO: Implement
-    return True
-
-def get_start_date_of_week(timestamp: datetime) -> datetime:
-    weekday = datetime(timestamp.year, timestamp.month, timestamp.day)
-    start_of_week = weekday - timedelta(days=weekday.weekday())
-    
-    return  start_of_week
\ No newline at end of file
+# Timestamps are stored in UTC and timezones are whole hours from UTC. A week starts at midnight on Monday in
+# the timezone it is seen from, which is some whole hour in UTC.
+HOURS_PER_WEEK = 7 * 24
+
+# Monday 1970-01-05 00:00 UTC, the start of week bucket 0
+EPOCH = datetime(1970, 1, 5)
+
+def to_hours(timestamp: datetime) -> int:
+    # Whole hours since EPOCH, rounded down. Week keys and activity ranges are compared in these units.
+    return (timestamp - EPOCH) // timedelta(hours=1)
+
+def week_bucket(timestamp: datetime, timezone_offset: int = 0) -> int:
+    # The number of the week that the timestamp falls in, as seen from UTC+timezone_offset
+    return (to_hours(timestamp) + timezone_offset) // HOURS_PER_WEEK
+
+def get_start_date_of_week(timestamp: datetime, timezone_offset: int = 0) -> datetime:
+    # The UTC time of midnight on the Monday before the timestamp, as seen from UTC+timezone_offset
+    return EPOCH + timedelta(hours=week_bucket(timestamp, timezone_offset) * HOURS_PER_WEEK - timezone_offset)
+
+def are_dates_in_same_week(date1: datetime, date2: datetime, timezone_offset: int = 0) -> bool:
+    return week_bucket(date1, timezone_offset) == week_bucket(date2, timezone_offset)
+
+def week_key(week_start: datetime) -> int:
+    # Identifies the week that starts at week_start. Weeks seen from different timezones have different keys.
+    return to_hours(week_start)
+
+def week_span(start: datetime, end: datetime) -> tuple[int, int]:
+    return to_hours(start), to_hours(end)
+
+def week_overlaps_span(key: int, span: tuple[int, int]) -> bool:
+    # Whether a time range could appear in the week. Rounding the range down to whole hours doesn't change the
+    # result, since weeks start on whole hours.
+    start, end = span
+    return key <= end and start < key + HOURS_PER_WEEK
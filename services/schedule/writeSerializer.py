@@ -0,0 +1,37 @@
+import asyncio
+import uuid as uuid_pkg
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+# Runs the writes to a schedule one at a time, in the order they arrive. A write's overlap and version checks
+# then can't race another write of the same schedule in this process, and its broadcast goes out before the
+# next write starts, so clients see the changes in change_seq order. Writes of different schedules still run
+# concurrently. Only the event loop touches the locks.
+class ScheduleWriteSerializer:
+    def __init__(self):
+        self._locks : dict[uuid_pkg.UUID, asyncio.Lock] = {}
+        self._writers : dict[uuid_pkg.UUID, int] = {}
+
+    @asynccontextmanager
+    async def serialize(self, schedule_id: uuid_pkg.UUID) -> AsyncIterator[None]:
+        lock = self._locks.get(schedule_id)
+        if lock is None:
+            lock = self._locks[schedule_id] = asyncio.Lock()
+        self._writers[schedule_id] = self._writers.get(schedule_id, 0) + 1
+
+        try:
+            # asyncio locks are acquired in the order they are waited on
+            async with lock:
+                yield
+        finally:
+            # Forget the schedule once nothing is writing to it
+            self._writers[schedule_id] -= 1
+            if not self._writers[schedule_id]:
+                del self._writers[schedule_id]
+                del self._locks[schedule_id]
+
+    def waiting(self) -> int:
+        # Writes queued behind another write of the same schedule
+        return sum(writers - 1 for writers in self._writers.values())
+
+schedule_writes = ScheduleWriteSerializer()
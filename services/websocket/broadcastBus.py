@@ -0,0 +1,264 @@
+import asyncio
+import json
+from abc import ABC, abstractmethod
+import logging
+import os
+import sys
+import uuid as uuid_pkg
+from datetime import datetime
+from typing import Awaitable, Callable
+from urllib.parse import urlparse
+
+from .encoding import Payload
+
+logger = logging.getLogger(__name__)
+
+class ScheduleEvent:
+    def __init__(self, schedule_id: uuid_pkg.UUID, target_week: datetime, payload: Payload, origin: str | None = None, \
+        week_spans: list[tuple[int, int]] = [], reply_to: str | None = None):
+        self.schedule_id = schedule_id
+        self.target_week = target_week
+        self.payload = payload
+        # The instance_id of the bus that published the event
+        self.origin = origin
+        # The changed time ranges in whole hours, see utilities.week_span. The viewers of every week they
+        # overlap are notified along with the viewers of target_week.
+        self.week_spans = week_spans
+        # The connection id of the socket whose request made the change, in the publishing process
+        self.reply_to = reply_to
+
+    def dump(self) -> str:
+        obj_dict = {
+            "schedule_id" : str(self.schedule_id),
+            "target_week" : self.target_week.isoformat(),
+            "payload" : self.payload.text,
+            "origin" : self.origin,
+            "week_spans" : self.week_spans,
+            "reply_to" : self.reply_to,
+        }
+        return json.dumps(obj_dict)
+
+    @staticmethod
+    def load(data: str | dict) -> 'ScheduleEvent':
+        obj_dict = json.loads(data) if isinstance(data, str) else data
+        return ScheduleEvent(uuid_pkg.UUID(obj_dict['schedule_id']), datetime.fromisoformat(obj_dict['target_week']), Payload(obj_dict['payload']), \
+            obj_dict.get('origin'), [tuple(span) for span in obj_dict.get('week_spans', [])], \
+            obj_dict.get('reply_to'))
+
+EventHandler = Callable[[ScheduleEvent], Awaitable[None]]
+
+# Carries committed schedule changes to every process that has clients connected to the schedule. Each
+# process subscribes to the schedules its clients are on, and publishing delivers the event to every
+# subscriber, including the publishing process itself.
+class BroadcastBus(ABC):
+    def __init__(self):
+        self.instance_id = uuid_pkg.uuid4().hex
+        self.handlers : dict[uuid_pkg.UUID, EventHandler] = {}
+        # Called with each subscribed schedule when events may have been missed, e.g. after reconnecting
+        self.reconnect_handler : Callable[[uuid_pkg.UUID], None] | None = None
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    def subscribe(self, schedule_id: uuid_pkg.UUID, handler: EventHandler) -> None:
+        self.handlers[schedule_id] = handler
+
+    def unsubscribe(self, schedule_id: uuid_pkg.UUID) -> None:
+        self.handlers.pop(schedule_id, None)
+
+    @abstractmethod
+    async def publish(self, event: ScheduleEvent) -> None:
+        ...
+
+    async def _deliver(self, event: ScheduleEvent) -> None:
+        handler = self.handlers.get(event.schedule_id)
+        if handler:
+            await handler(event)
+
+# Only reaches the current process. This is the default for a single worker deployment.
+class InProcessBroadcastBus(BroadcastBus):
+    async def publish(self, event: ScheduleEvent) -> None:
+        await self._deliver(event)
+
+# Connects to a BroadcastRelay over TCP. Messages are newline delimited JSON objects:
+#   {"op": "sub", "schedule_id": ...}
+#   {"op": "unsub", "schedule_id": ...}
+#   {"op": "pub", "event": {...}}
+# The relay forwards "pub" messages to every other connection subscribed to the event's schedule.
+class SocketBroadcastBus(BroadcastBus):
+    RECONNECT_DELAY_SECONDS = 1.0
+    PUBLISH_TIMEOUT_SECONDS = 5.0
+
+    def __init__(self, host: str, port: int):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self._writer : asyncio.StreamWriter | None = None
+        self._reader_task : asyncio.Task | None = None
+        self._connected = asyncio.Event()
+
+    async def start(self) -> None:
+        self._reader_task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            logger.warning("Broadcast relay at %s:%s is unreachable, events will only reach this process until it is up", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._reader_task:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+
+    def subscribe(self, schedule_id: uuid_pkg.UUID, handler: EventHandler) -> None:
+        super().subscribe(schedule_id, handler)
+        self._send({"op" : "sub", "schedule_id" : str(schedule_id)})
+
+    def unsubscribe(self, schedule_id: uuid_pkg.UUID) -> None:
+        super().unsubscribe(schedule_id)
+        self._send({"op" : "unsub", "schedule_id" : str(schedule_id)})
+
+    async def publish(self, event: ScheduleEvent) -> None:
+        # The local subscribers are notified directly, so they hear about the change even if the relay is down or
+        # stalled. The relay's copy of the event is skipped when it comes back.
+        await self._deliver(event)
+
+        writer = self._writer
+        if not self._send({"op" : "pub", "event" : json.loads(event.dump())}):
+            # Without the relay the other processes can't be reached
+            return
+
+        try:
+            await asyncio.wait_for(writer.drain(), self.PUBLISH_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            # A relay that doesn't keep up would hold up every write. Dropping the connection makes _run reconnect,
+            # and the reconnect invalidates what the events lost in between could have changed.
+            logger.warning("Broadcast relay at %s:%s stalled, reconnecting", self.host, self.port)
+            writer.transport.abort()
+        except (ConnectionError, OSError):
+            pass
+
+    def _send(self, message: dict) -> bool:
+        if not self._writer or self._writer.is_closing():
+            return False
+        self._writer.write(json.dumps(message).encode() + b"\n")
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+                # Restore the subscriptions after (re)connecting
+                for schedule_id in self.handlers:
+                    self._send({"op" : "sub", "schedule_id" : str(schedule_id)})
+                await self._writer.drain()
+                self._connected.set()
+
+                # Events published while the bus was disconnected never arrived
+                if self.reconnect_handler:
+                    for schedule_id in list(self.handlers):
+                        self.reconnect_handler(schedule_id)
+
+                while line := await reader.readline():
+                    message = json.loads(line)
+                    # Events published by this process were already delivered by publish
+                    if message["op"] == "pub" and message["event"].get("origin") != self.instance_id:
+                        try:
+                            await self._deliver(ScheduleEvent.load(message["event"]))
+                        except Exception:
+                            logger.exception("Failed to deliver schedule event")
+            except (ConnectionError, OSError):
+                pass
+            finally:
+                self._connected.clear()
+                if self._writer:
+                    self._writer.close()
+                    self._writer = None
+
+            logger.warning("Lost connection to broadcast relay at %s:%s, reconnecting", self.host, self.port)
+            await asyncio.sleep(self.RECONNECT_DELAY_SECONDS)
+
+# The hub that SocketBroadcastBus instances connect to. It can be run standalone with
+#   python -m services.websocket.broadcastBus <host> <port>
+# or started inside a test to stand in for a real deployment.
+class BroadcastRelay:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.subscribers : dict[str, set[asyncio.StreamWriter]] = {}
+        self._server : asyncio.Server | None = None
+        self._handlers : set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # Resolve the port if an ephemeral one was requested
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            for handler in list(self._handlers):
+                handler.cancel()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        await self._server.serve_forever()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        subscriptions = set()
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if message["op"] == "sub":
+                    subscriptions.add(message["schedule_id"])
+                    self.subscribers.setdefault(message["schedule_id"], set()).add(writer)
+                elif message["op"] == "unsub":
+                    subscriptions.discard(message["schedule_id"])
+                    self._remove_subscriber(message["schedule_id"], writer)
+                elif message["op"] == "pub":
+                    # The publisher already delivered the event to its own subscribers
+                    for subscriber in list(self.subscribers.get(message["event"]["schedule_id"], ())):
+                        if subscriber is not writer:
+                            subscriber.write(line)
+        except (ConnectionError, OSError, asyncio.CancelledError):
+            pass
+        finally:
+            self._handlers.discard(handler)
+            for schedule_id in subscriptions:
+                self._remove_subscriber(schedule_id, writer)
+            writer.close()
+
+    def _remove_subscriber(self, schedule_id: str, writer: asyncio.StreamWriter) -> None:
+        writers = self.subscribers.get(schedule_id)
+        if writers is not None:
+            writers.discard(writer)
+            if not writers:
+                del self.subscribers[schedule_id]
+
+# BROADCAST_BUS_URL selects the backend, e.g. tcp://127.0.0.1:7010. When unset, events stay in process.
+def create_broadcast_bus() -> BroadcastBus:
+    bus_url = os.getenv("BROADCAST_BUS_URL")
+    if not bus_url:
+        return InProcessBroadcastBus()
+
+    parsed_url = urlparse(bus_url)
+    if parsed_url.scheme != "tcp":
+        raise ValueError(f"Unsupported broadcast bus url: {bus_url}")
+    return SocketBroadcastBus(parsed_url.hostname, parsed_url.port)
+
+if __name__ == "__main__":
+    host = sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 7010
+    asyncio.run(BroadcastRelay(host, port).serve_forever())
@@ -1,19 +1,40 @@
+import uuid as uuid_pkg
 from fastapi import WebSocket
 
+from services.websocket.encoding import FrameEncoding, Payload
+from services.websocket.outboundQueue import OutboundQueue
 from services.websocket.protocols import ResponseBase
 
+# Sockets are identified by a connection id of their own rather than by the client's id, since a user can have
+# several sockets open at once, e.g. one per tab.
 class ConnectionManager:
     def __init__(self):
-        self.active_connections : dict[str, WebSocket] = {}
+        self.active_connections : dict[uuid_pkg.UUID, WebSocket] = {}
+        self.outbound_queues : dict[uuid_pkg.UUID, OutboundQueue] = {}
 
-    async def connect(self, websocket: WebSocket, client_id: str) -> None:
+    async def connect(self, websocket: WebSocket, connection_id: uuid_pkg.UUID, encoding: FrameEncoding = FrameEncoding.JSON) -> None:
         await websocket.accept()
-        self.active_connections[client_id] = websocket
-    
-    def disconnect(self, client_id: str) -> None:
-        del self.active_connections[client_id]
-        
-    async def send_response(self, client_ids: list[str], response : ResponseBase) -> None:
-        for client_id in client_ids:
-            if client_id in self.active_connections:
-                await self.active_connections[client_id].send_text(response.dump())
\ No newline at end of file
+        self.active_connections[connection_id] = websocket
+        self.outbound_queues[connection_id] = OutboundQueue(websocket, encoding, lambda: self._snapshot(connection_id))
+
+    def disconnect(self, connection_id: uuid_pkg.UUID) -> None:
+        del self.active_connections[connection_id]
+        self.outbound_queues.pop(connection_id).close()
+
+    async def send_response(self, connection_ids: list[uuid_pkg.UUID], response : ResponseBase) -> None:
+        await self.send_payload(connection_ids, response.payload(), reply=response.request_id is not None)
+
+    async def send_payload(self, connection_ids: list[uuid_pkg.UUID], payload : Payload, snapshot: bool = False, reply: bool = False) -> None:
+        # Queue the serialized response on each socket's own writer, so the sender never waits for a
+        # slow socket to drain. Replies answer a request of the socket they are sent to.
+        for connection_id in connection_ids:
+            outbound_queue = self.outbound_queues.get(connection_id)
+            if outbound_queue is not None:
+                outbound_queue.put(payload, snapshot, reply)
+
+    def queued_frames(self) -> int:
+        return sum(len(outbound_queue) for outbound_queue in self.outbound_queues.values())
+
+    async def _snapshot(self, connection_id: uuid_pkg.UUID) -> Payload | None:
+        # The current state to send a socket whose queue overflowed. Without one the socket is closed.
+        return None
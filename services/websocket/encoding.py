@@ -0,0 +1,96 @@
+import json
+import uuid as uuid_pkg
+from datetime import datetime, timezone
+from enum import Enum
+
+from database.models import Activity
+
+# orjson and msgpack are optional. Without orjson the standard library is used, and without msgpack clients
+# can only negotiate JSON frames.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class FrameEncoding(str, Enum):
+    JSON = "json"
+    MSGPACK = "msgpack"
+
+def negotiate_encoding(requested : str | None) -> FrameEncoding:
+    if requested == FrameEncoding.MSGPACK and msgpack:
+        return FrameEncoding.MSGPACK
+    return FrameEncoding.JSON
+
+def encode_json(obj) -> str:
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, default=str)
+
+def decode_json(data : str | bytes):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def decode_frame(message : dict):
+    # A websocket.receive message holds either a text frame or a binary (MessagePack) frame
+    if message.get("bytes") is not None:
+        if not msgpack:
+            raise ValueError("Binary frames are not supported")
+        return msgpack.unpackb(message["bytes"])
+    return decode_json(message["text"])
+
+# Timestamps are stored as naive UTC. Clients may send them with an offset, e.g. JavaScript's toISOString()
+# ends in "Z", so aware timestamps are converted to UTC and the offset dropped.
+def to_naive_utc(timestamp : datetime) -> datetime:
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+def parse_timestamp(value : str) -> datetime:
+    return to_naive_utc(datetime.fromisoformat(value))
+
+# A serialized response that is shared by every recipient. The JSON text is produced once, the MessagePack
+# form is only produced the first time a binary client needs it.
+class Payload:
+    def __init__(self, text : str, obj : dict | None = None):
+        self.text = text
+        self._obj = obj
+        self._msgpack = None
+
+    def msgpack(self) -> bytes:
+        if self._msgpack is None:
+            obj = self._obj if self._obj is not None else decode_json(self.text)
+            self._msgpack = msgpack.packb(obj, default=str)
+        return self._msgpack
+
+def _identity(value):
+    return value
+
+def _to_iso(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def _to_str(value):
+    return str(value) if isinstance(value, uuid_pkg.UUID) else value
+
+def _compile_activity_serializer():
+    # Resolve a converter for each column once instead of running the pydantic serializer for every activity.
+    converters = []
+    for name, field in Activity.model_fields.items():
+        if field.annotation is datetime:
+            converters.append((name, _to_iso))
+        elif field.annotation is uuid_pkg.UUID:
+            converters.append((name, _to_str))
+        else:
+            converters.append((name, _identity))
+    return tuple(converters)
+
+_activity_converters = _compile_activity_serializer()
+
+# Equivalent to activity.model_dump(mode='json')
+def serialize_activity(activity : Activity) -> dict:
+    return {name : converter(getattr(activity, name)) for name, converter in _activity_converters}
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import time
+from collections import deque
+from enum import Enum
+from typing import Awaitable, Callable
+
+from fastapi import WebSocket
+
+from .encoding import FrameEncoding, Payload
+from ..monitoring import metrics
+
+# What to do with a socket whose queue is full. Only broadcasts and snapshots are dropped or replaced, the
+# replies to the client's own requests are always kept since the client waits for each of them by its id.
+class OverflowPolicy(str, Enum):
+    # Drop the oldest queued broadcast to make room
+    DROP = "drop"
+    # Discard the queued broadcasts and send the client a fresh snapshot of its week instead
+    RESYNC = "resync"
+    # Close the socket, the client reconnects and catches up with since_seq
+    DISCONNECT = "disconnect"
+
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", 256))
+OUTBOUND_OVERFLOW_POLICY = OverflowPolicy(os.getenv("OUTBOUND_OVERFLOW_POLICY", OverflowPolicy.RESYNC.value))
+SEND_TIMEOUT_SECONDS = float(os.getenv("SEND_TIMEOUT_SECONDS", 10))
+
+# Close code for clients that are evicted for not keeping up (1013 Try Again Later)
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# The frames waiting to be written to one socket. Frames are put without waiting and written by the queue's
+# own writer task, so a slow socket only ever delays itself.
+class OutboundQueue:
+    def __init__(self, websocket: WebSocket, encoding: FrameEncoding, resync: Callable[[], Awaitable[Payload | None]], \
+        max_size: int = OUTBOUND_QUEUE_SIZE, policy: OverflowPolicy = OUTBOUND_OVERFLOW_POLICY, send_timeout: float = SEND_TIMEOUT_SECONDS):
+        self.websocket = websocket
+        self.encoding = encoding
+        self.resync = resync
+        self.max_size = max_size
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.closed = False
+
+        # (payload, snapshot, reply, queued_at) tuples. A None payload stands for a snapshot that is produced when
+        # it is written.
+        self._frames : deque[tuple[Payload | None, bool, bool, float]] = deque()
+        self._ready = asyncio.Event()
+        self._close_task = None
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def put(self, payload: Payload, snapshot: bool = False, reply: bool = False) -> None:
+        if self.closed:
+            return
+
+        # A newer snapshot of the client's week supersedes the ones that haven't been written yet
+        if snapshot and any(queued_snapshot for _, queued_snapshot, _, _ in self._frames):
+            self._frames = deque(frame for frame in self._frames if not frame[1])
+
+        if len(self._frames) >= self.max_size:
+            replies = [frame for frame in self._frames if frame[2]]
+            # A client that doesn't read the replies to its own requests can't be helped by dropping frames
+            if self.policy == OverflowPolicy.DISCONNECT or len(replies) >= self.max_size:
+                self.evict("full")
+                return
+            elif self.policy == OverflowPolicy.DROP:
+                self._frames.remove(next(frame for frame in self._frames if not frame[2]))
+                metrics.outbound_dropped_frames.inc()
+            else:
+                self._frames = deque(replies)
+                if reply:
+                    self._frames.append((payload, snapshot, reply, time.perf_counter()))
+                self._frames.append((None, True, False, time.perf_counter()))
+                metrics.outbound_resyncs.inc()
+                # The snapshot covers the broadcast being put as well
+                self._ready.set()
+                return
+
+        self._frames.append((payload, snapshot, reply, time.perf_counter()))
+        self._ready.set()
+
+    def close(self) -> None:
+        self.closed = True
+        self._frames.clear()
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+    def evict(self, reason: str) -> None:
+        metrics.outbound_evictions.labels(reason).inc()
+        self.close()
+        self._close_task = asyncio.create_task(self._close_socket())
+
+    async def _write_loop(self) -> None:
+        try:
+            while True:
+                while not self._frames:
+                    self._ready.clear()
+                    await self._ready.wait()
+
+                payload, _, _, queued_at = self._frames.popleft()
+                if payload is None:
+                    payload = await self.resync()
+                    if payload is None:
+                        # Nothing to resync the client with, so it has to reconnect
+                        self.evict("resync")
+                        return
+
+                await asyncio.wait_for(self._send(payload), self.send_timeout)
+                metrics.outbound_send_seconds.observe(time.perf_counter() - queued_at)
+        except asyncio.TimeoutError:
+            self.evict("timeout")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The socket is gone. The client's receive loop notices and cleans up the connection.
+            self.close()
+
+    async def _send(self, payload: Payload) -> None:
+        if self.encoding == FrameEncoding.MSGPACK:
+            await self.websocket.send_bytes(payload.msgpack())
+        else:
+            await self.websocket.send_text(payload.text)
+
+    async def _close_socket(self) -> None:
+        try:
+            await self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+        except Exception:
+            pass
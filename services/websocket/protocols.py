@@ -1,42 +1,67 @@
 import uuid as uuid_pkg
-import json
 from datetime import datetime
 from database.models import Activity
+from .encoding import Payload, encode_json, parse_timestamp, serialize_activity
+from ..monitoring import metrics
 
 class ResponseBase: 
     def __init__(self, status: int, action: str, request_id : str | None = None):
         self.status = status
         self.action = action
         self.request_id = request_id
+        self._payload = None
+        # The time ranges a change affected, used to route its broadcast to the viewers of those weeks. Not sent.
+        self.changed_ranges : list[tuple[datetime, datetime]] = []
 
-    def dump(self):
+    def to_dict(self) -> dict:
         obj_dict = {
             "status" : self.status,
             "action" : self.action,
             "request_id" : self.request_id,
         }
-        return json.dumps(obj_dict)
+        return obj_dict
+
+    # A response is serialized once, no matter how many clients it is sent to. It should not be modified after.
+    def payload(self) -> Payload:
+        if self._payload is None:
+            with metrics.serialize_seconds.labels(type(self).__name__).time():
+                obj_dict = self.to_dict()
+                self._payload = Payload(encode_json(obj_dict), obj_dict)
+        return self._payload
+
+    def dump(self) -> str:
+        return self.payload().text
 
 class ActivityResponse(ResponseBase):
-    def __init__(self, status: int, action: str, target_week : datetime, activities : list[Activity] = [], request_id : str | None = None):
+    def __init__(self, status: int, action: str, target_week : datetime, activities : list[Activity] = [], request_id : str | None = None, \
+        change_seq : int | None = None, descriptions : dict[str, str] | None = None, changed_ranges : list[tuple[datetime, datetime]] = []):
         super().__init__(status, action, request_id)
+        self.changed_ranges = changed_ranges
         self.target_week = target_week
         self.activities = activities
+        # The schedule's change_seq that the activities are at least as recent as
+        self.change_seq = change_seq
+        # The descriptions of the activities keyed by activity id, only when the client asked for them
+        self.descriptions = descriptions
 
-    def dump(self):
+    def to_dict(self) -> dict:
         obj_dict = {
             "status" : self.status,
             "action" : self.action,
             "target_week" : self.target_week.isoformat(),
             "request_id" : self.request_id,
+            "change_seq" : self.change_seq,
         }
 
         activities = []
         for activity in self.activities:
-            activities.append(activity.model_dump(mode='json'))
+            # Cached weeks hold activities that are already in their JSON form
+            activities.append(activity if isinstance(activity, dict) else serialize_activity(activity))
         obj_dict["activities"] = activities
+        if self.descriptions is not None:
+            obj_dict["descriptions"] = self.descriptions
 
-        return json.dumps(obj_dict)
+        return obj_dict
 
 class DescriptionResponse(ResponseBase):
     def __init__(self, status : int, action : str, activity_id : str, description : str = '', request_id : str | None = None):
@@ -44,7 +69,7 @@ class DescriptionResponse(ResponseBase):
         self.activity_id = activity_id
         self.description = description
 
-    def dump(self):
+    def to_dict(self) -> dict:
         obj_dict = {
             "status" : self.status,
             "action" : self.action,
@@ -53,29 +78,89 @@ class DescriptionResponse(ResponseBase):
             "description" : self.description
         }
 
-        return json.dumps(obj_dict)
+        return obj_dict
+
+class BatchResponse(ResponseBase):
+    def __init__(self, status : int, action : str, target_week : datetime, results : list[ResponseBase], activities : list[dict], \
+        deleted_activity_ids : list[str], request_id : str | None = None, change_seq : int | None = None, \
+        changed_ranges : list[tuple[datetime, datetime]] = []):
+        super().__init__(status, action, request_id)
+        self.changed_ranges = changed_ranges
+        self.target_week = target_week
+        self.results = results
+        self.activities = activities
+        self.deleted_activity_ids = deleted_activity_ids
+        self.change_seq = change_seq
+
+    def to_dict(self) -> dict:
+        obj_dict = {
+            "status" : self.status,
+            "action" : self.action,
+            "target_week" : self.target_week.isoformat(),
+            "request_id" : self.request_id,
+            "results" : [result.to_dict() for result in self.results],
+            "activities" : self.activities,
+            "deleted_activity_ids" : self.deleted_activity_ids,
+            "change_seq" : self.change_seq,
+        }
+
+        return obj_dict
+
+# The changes to a schedule since the change_seq a client last saw. Clients apply the deletions and then the activities.
+class SyncResponse(ResponseBase):
+    def __init__(self, status : int, action : str, change_seq : int | None = None, activities : list[dict] = [], \
+        deleted_activity_ids : list[str] = [], request_id : str | None = None):
+        super().__init__(status, action, request_id)
+        self.change_seq = change_seq
+        self.activities = activities
+        self.deleted_activity_ids = deleted_activity_ids
+
+    def to_dict(self) -> dict:
+        obj_dict = {
+            "status" : self.status,
+            "action" : self.action,
+            "request_id" : self.request_id,
+            "change_seq" : self.change_seq,
+            "activities" : self.activities,
+            "deleted_activity_ids" : self.deleted_activity_ids,
+        }
+
+        return obj_dict
 
 class Request:
     def __init__(self, json : dict):        
+        if not isinstance(json, dict):
+            raise TypeError("A request must be an object")
+
         self.id = json.get('id', None)
         self.client_id = json['client_id']
         self.action = json['action']
-        self.target_week = datetime.fromisoformat(json['target_week'])
-        self.activity_id = json.get('activity_id', None)
+        self.target_week = parse_timestamp(json['target_week'])
+        self.activity_id = uuid_pkg.UUID(json['activity_id']) if json.get('activity_id') else None
         self.description = json.get('description', None)
+        self.since_seq = int(json['since_seq']) if json.get('since_seq') is not None else None
+        # FULLWEEK requests can ask for the week's descriptions to be sent along with its activities
+        self.include_descriptions = bool(json.get('include_descriptions', False))
+        self.activity = None
+
+        # The operations of a batch request. They inherit the client and week of the batch.
+        self.operations = [Request({'client_id' : self.client_id, 'target_week' : json['target_week'], **operation}) \
+            for operation in json.get('operations', [])]
 
         activity_dict = json.get('activity', None)
         if activity_dict:    
             # Generate an id if there aren't any
             if 'id' not in activity_dict:
                 id = uuid_pkg.uuid4()
-                activity_dict.id = id
+                activity_dict['id'] = id
                 self.activity_id = id
             
             # Manually convert non string fields
+            activity_dict['id'] = uuid_pkg.UUID(str(activity_dict['id']))
+            activity_dict['schedule_id'] = uuid_pkg.UUID(activity_dict['schedule_id'])
             activity_dict['local_timezone'] = int(activity_dict['local_timezone'])
-            activity_dict['start'] = datetime.fromisoformat(activity_dict['start'])
-            activity_dict['end'] = datetime.fromisoformat(activity_dict['end'])
+            activity_dict['start'] = parse_timestamp(activity_dict['start'])
+            activity_dict['end'] = parse_timestamp(activity_dict['end'])
 
             # Use the Pydantic model's __init__ function to create an instance from dict
             self.activity = Activity(**activity_dict)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The tests import the services from the repository root. The database module reads its connection string when
+# it is imported, and the pure functions under test never use it, so an in memory database is enough.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TEST_DB_CONNECTION_STRING", "sqlite://")
@@ -0,0 +1,115 @@
+import random
+from datetime import datetime, timedelta
+
+from services.schedule.intervalIndex import IntervalIndex, ScheduleIntervals
+
+START = datetime(2025, 6, 23)
+
+def minutes(value: int) -> datetime:
+    return START + timedelta(minutes=value)
+
+def overlaps_brute_force(ranges: dict, start: datetime, end: datetime, activity_id) -> bool:
+    return any(other_start < end and start < other_end for other_id, (other_start, other_end) in ranges.items() \
+        if other_id != str(activity_id))
+
+def random_schedule(rng: random.Random) -> dict:
+    # Activities that don't overlap each other, as in a schedule
+    ranges, time = {}, 0
+    for i in range(rng.randrange(0, 30)):
+        time += rng.randrange(0, 5)
+        length = rng.randrange(1, 10)
+        ranges[f"a{i}"] = (minutes(time), minutes(time + length))
+        time += length
+    return ranges
+
+def test_overlaps_matches_brute_force():
+    rng = random.Random(5)
+    for _ in range(300):
+        ranges = random_schedule(rng)
+        intervals = ScheduleIntervals([(start, end, activity_id) for activity_id, (start, end) in ranges.items()])
+        for _ in range(50):
+            start = rng.randrange(-5, 200)
+            end = start + rng.randrange(1, 30)
+            activity_id = rng.choice([None, *ranges]) if ranges else None
+            assert intervals.overlaps(minutes(start), minutes(end), activity_id) == \
+                overlaps_brute_force(ranges, minutes(start), minutes(end), activity_id)
+
+def test_touching_ranges_dont_overlap():
+    intervals = ScheduleIntervals([(minutes(0), minutes(10), "a")])
+    assert not intervals.overlaps(minutes(10), minutes(20))
+    assert not intervals.overlaps(minutes(-10), minutes(0))
+    assert intervals.overlaps(minutes(9), minutes(20))
+
+def test_an_activity_doesnt_overlap_itself():
+    intervals = ScheduleIntervals([(minutes(0), minutes(10), "a")])
+    assert not intervals.overlaps(minutes(5), minutes(15), "a")
+    assert intervals.overlaps(minutes(5), minutes(15), "b")
+
+def test_add_and_remove_match_brute_force():
+    rng = random.Random(7)
+    ranges = {}
+    intervals = ScheduleIntervals([])
+    for _ in range(2000):
+        activity_id = f"a{rng.randrange(20)}"
+        if rng.random() < 0.3:
+            ranges.pop(activity_id, None)
+            intervals.remove(activity_id)
+            continue
+
+        start = rng.randrange(0, 300)
+        end = start + rng.randrange(1, 20)
+        # Only ranges that fit are added, so the schedule never overlaps itself
+        if not overlaps_brute_force(ranges, minutes(start), minutes(end), activity_id):
+            ranges[activity_id] = (minutes(start), minutes(end))
+            intervals.add(activity_id, minutes(start), minutes(end))
+
+        assert len(intervals) == len(ranges)
+        probe = rng.randrange(0, 300)
+        assert intervals.overlaps(minutes(probe), minutes(probe + 5)) == overlaps_brute_force(ranges, minutes(probe), minutes(probe + 5), None)
+
+def test_apply_in_order_keeps_the_intervals_current():
+    intervals = ScheduleIntervals([(minutes(0), minutes(10), "a")], change_seq=1)
+    intervals.apply(2, [("b", (minutes(10), minutes(20)))])
+    intervals.apply(3, [("a", (minutes(30), minutes(40))), ("b", None)])
+
+    assert intervals.change_seq == 3
+    assert len(intervals) == 1
+    assert not intervals.overlaps(minutes(0), minutes(30))
+    assert intervals.overlaps(minutes(35), minutes(36))
+
+def test_apply_of_an_earlier_change_is_ignored():
+    # The intervals were loaded after the change was committed, so they already include it
+    intervals = ScheduleIntervals([(minutes(0), minutes(10), "a")], change_seq=5)
+    intervals.apply(5, [("a", None)])
+    intervals.apply(4, [("b", (minutes(20), minutes(30)))])
+
+    assert intervals.change_seq == 5
+    assert len(intervals) == 1
+
+def test_apply_after_a_missed_change_marks_the_intervals_stale():
+    intervals = ScheduleIntervals([], change_seq=1)
+    intervals.apply(3, [("a", (minutes(0), minutes(10)))])
+    assert intervals.change_seq is None
+
+    # Stale intervals stay stale
+    intervals.apply(4, [("b", (minutes(20), minutes(30)))])
+    assert intervals.change_seq is None
+    assert len(intervals) == 1
+
+def test_index_only_returns_intervals_at_the_requested_change_seq():
+    index = IntervalIndex(max_entries=4)
+    index.put_intervals("s", ScheduleIntervals([], change_seq=1), index.generation("s"))
+
+    assert index.get_intervals("s", 1) is not None
+    assert index.get_intervals("s", 2) is None
+
+    index.apply("s", 2, [("a", (minutes(0), minutes(10)))])
+    assert index.get_intervals("s", 2) is not None
+
+def test_index_drops_a_load_that_raced_with_a_change():
+    index = IntervalIndex(max_entries=4)
+    generation = index.generation("s")
+    index.apply("s", 2, [("a", (minutes(0), minutes(10)))])
+    index.put_intervals("s", ScheduleIntervals([], change_seq=1), generation)
+
+    assert index.get_intervals("s", 1) is None
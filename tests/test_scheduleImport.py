@@ -0,0 +1,60 @@
+import random
+from datetime import datetime, timedelta
+
+from services.schedule.scheduleImport import _sweep
+
+START = datetime(2025, 6, 23)
+
+def minutes(value: int) -> datetime:
+    return START + timedelta(minutes=value)
+
+def row(start: int, end: int) -> dict:
+    return {"start" : minutes(start), "end" : minutes(end)}
+
+def overlaps(first: tuple, second: tuple) -> bool:
+    return first[0] < second[1] and second[0] < first[1]
+
+def sweep_brute_force(rows: list[tuple[int, dict]], existing_intervals: list[tuple]) -> dict[int, bool]:
+    # Rows are taken in start order and kept unless they overlap an existing activity or a row kept before them
+    kept, accepted = [], {}
+    for row_number, values in sorted(rows, key=lambda item: (item[1]["start"], item[1]["end"], item[0])):
+        time_range = (values["start"], values["end"])
+        accepted[row_number] = not any(overlaps(time_range, other) for other in existing_intervals + kept)
+        if accepted[row_number]:
+            kept.append(time_range)
+    return accepted
+
+def random_existing(rng: random.Random) -> list[tuple]:
+    existing, time = [], 0
+    for _ in range(rng.randrange(0, 10)):
+        time += rng.randrange(0, 20)
+        length = rng.randrange(1, 15)
+        existing.append((minutes(time), minutes(time + length)))
+        time += length
+    return existing
+
+def test_sweep_matches_brute_force():
+    rng = random.Random(11)
+    for _ in range(1000):
+        existing_intervals = random_existing(rng)
+        rows = []
+        for row_number in range(1, rng.randrange(1, 20)):
+            start = rng.randrange(0, 150)
+            rows.append((row_number, row(start, start + rng.randrange(1, 20))))
+
+        results = list(_sweep(rows, existing_intervals))
+        assert sorted(row_number for row_number, _, _ in results) == [row_number for row_number, _ in rows]
+        assert {row_number : error is None for row_number, _, error in results} == sweep_brute_force(rows, existing_intervals)
+
+def test_sweep_keeps_the_earliest_of_overlapping_rows():
+    results = list(_sweep([(1, row(10, 30)), (2, row(0, 20))], []))
+    assert [(row_number, error) for row_number, _, error in results] == [(2, None), (1, "Overlaps row 2")]
+
+def test_sweep_reports_overlaps_with_existing_activities():
+    results = list(_sweep([(1, row(5, 15)), (2, row(20, 30)), (3, row(30, 40))], [(minutes(10), minutes(25))]))
+    assert [(row_number, error) for row_number, _, error in results] == \
+        [(1, "Overlaps an existing activity"), (2, "Overlaps an existing activity"), (3, None)]
+
+def test_sweep_accepts_touching_rows():
+    results = list(_sweep([(1, row(0, 10)), (2, row(10, 20))], [(minutes(20), minutes(30))]))
+    assert all(error is None for _, _, error in results)
@@ -0,0 +1,35 @@
+import random
+from datetime import datetime, timedelta
+
+from services.schedule.utilities import HOURS_PER_WEEK, get_start_date_of_week, week_bucket, week_key, week_overlaps_span, week_span
+
+def test_weeks_start_on_monday_midnight_in_the_timezone():
+    # Monday 2025-06-23 00:00 in UTC+9 is Sunday 15:00 UTC
+    assert get_start_date_of_week(datetime(2025, 6, 25, 12), 9) == datetime(2025, 6, 22, 15)
+    assert get_start_date_of_week(datetime(2025, 6, 22, 14), 9) == datetime(2025, 6, 15, 15)
+    assert get_start_date_of_week(datetime(2025, 6, 23, 2), -5) == datetime(2025, 6, 16, 5)
+    assert get_start_date_of_week(datetime(2025, 6, 23), 0) == datetime(2025, 6, 23)
+
+def test_week_bucket_matches_local_calendar():
+    rng = random.Random(3)
+    for _ in range(2000):
+        timestamp = datetime(2020, 1, 1) + timedelta(minutes=rng.randrange(0, 5 * 365 * 24 * 60))
+        timezone_offset = rng.randrange(-12, 15)
+        local = timestamp + timedelta(hours=timezone_offset)
+        local_monday = datetime(local.year, local.month, local.day) - timedelta(days=local.weekday())
+
+        week_start = get_start_date_of_week(timestamp, timezone_offset)
+        assert week_start == local_monday - timedelta(hours=timezone_offset)
+        assert week_bucket(week_start, timezone_offset) == week_bucket(timestamp, timezone_offset)
+        assert week_bucket(week_start - timedelta(seconds=1), timezone_offset) == week_bucket(timestamp, timezone_offset) - 1
+
+def test_week_overlaps_span_matches_brute_force():
+    rng = random.Random(4)
+    for _ in range(2000):
+        week_start = get_start_date_of_week(datetime(2025, 1, 1) + timedelta(hours=rng.randrange(0, 24 * 365)), rng.randrange(-12, 15))
+        week_end = week_start + timedelta(hours=HOURS_PER_WEEK)
+        start = week_start + timedelta(minutes=rng.randrange(-2 * 7 * 24 * 60, 2 * 7 * 24 * 60))
+        end = start + timedelta(minutes=rng.randrange(0, 3 * 24 * 60))
+
+        # A range that ends exactly when the week starts is still routed to it
+        assert week_overlaps_span(week_key(week_start), week_span(start, end)) == (week_start <= end and start < week_end)